@@ -268,7 +268,7 @@ with app.app_context():
         sqlalchemy.create_engine(ConnectionString("wgdashboard"))
     )
     InitWireguardConfigurationsList(startup=True)
-    DashboardClients: DashboardClients = DashboardClients(WireguardConfigurations)
+    DashboardClients: DashboardClients = DashboardClients(WireguardConfigurations, DashboardConfig)
     app.register_blueprint(createClientBlueprint(WireguardConfigurations, DashboardConfig, DashboardClients))
 
 _, APP_PREFIX = DashboardConfig.GetConfig("Server", "app_prefix")
@@ -1,7 +1,13 @@
 import datetime
 import hashlib
+import os
 import random
+import secrets
+import time
 import uuid
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import asdict, dataclass
+from functools import lru_cache
 
 import bcrypt
 import pyotp
@@ -17,10 +23,35 @@ from .DashboardLogger import DashboardLogger
 from flask import session
 
 
+BCRYPT_MIN_COST = 10
+BCRYPT_MAX_COST = 16
+BCRYPT_TARGET_SECONDS = 0.25
+BCRYPT_MAX_PASSWORD_BYTES = 72
+# Cost of bcrypt.gensalt(), used for every hash stored before the cost became configurable
+BCRYPT_DEFAULT_COST = 12
+
+
+@dataclass(slots=True)
+class ClientRow:
+    ClientID: str
+    Email: str
+    ClientGroup: str
+    Name: str | None
+
+    def toJson(self):
+        return asdict(self)
+
+
 class DashboardClients:
-    def __init__(self, wireguardConfigurations):
+    def __init__(self, wireguardConfigurations, dashboardConfig):
         self.logger = DashboardLogger()
-        self.engine = db.create_engine(ConnectionString("wgdashboard"))
+        self.bcryptCost = self.__getBcryptCost(dashboardConfig)
+        self.bcryptExecutor = ThreadPoolExecutor(max_workers=os.cpu_count() or 1,
+                                                 thread_name_prefix="bcrypt")
+        self.__dummyHash = self.__createDummyHash()
+        connectionString = ConnectionString("wgdashboard")
+        dateTimeType = db.DATETIME if 'sqlite:///' in connectionString else db.TIMESTAMP
+        self.engine = db.create_engine(connectionString)
         self.metadata = db.MetaData()
         self.OIDC = DashboardOIDC("Client")
         
@@ -31,13 +62,13 @@ class DashboardClients:
             db.Column('Password', db.String(500)),
             db.Column('TotpKey', db.String(500)),
             db.Column('TotpKeyVerified', db.Integer),
-            db.Column('CreatedDate', 
-                      (db.DATETIME if 'sqlite:///' in ConnectionString("wgdashboard") else db.TIMESTAMP),
-                      server_default=db.func.now()),
-            db.Column('DeletedDate', 
-                      (db.DATETIME if 'sqlite:///' in ConnectionString("wgdashboard") else db.TIMESTAMP)),
+            db.Column('CreatedDate', dateTimeType, server_default=db.func.now()),
+            db.Column('DeletedDate', dateTimeType),
             extend_existing=True,
         )
+        self.activeEmailIndex = db.Index('ix_dc_active_email', self.dashboardClientsTable.c.Email,
+                                         sqlite_where=self.dashboardClientsTable.c.DeletedDate.is_(None),
+                                         postgresql_where=self.dashboardClientsTable.c.DeletedDate.is_(None))
         
         self.dashboardOIDCClientsTable = db.Table(
             'DashboardOIDCClients', self.metadata,
@@ -45,11 +76,8 @@ class DashboardClients:
             db.Column('Email', db.String(255), nullable=False, index=True),
             db.Column('ProviderIssuer', db.String(500), nullable=False, index=True),
             db.Column('ProviderSubject', db.String(500), nullable=False, index=True),
-            db.Column('CreatedDate',
-                      (db.DATETIME if 'sqlite:///' in ConnectionString("wgdashboard") else db.TIMESTAMP),
-                      server_default=db.func.now()),
-            db.Column('DeletedDate',
-                      (db.DATETIME if 'sqlite:///' in ConnectionString("wgdashboard") else db.TIMESTAMP)),
+            db.Column('CreatedDate', dateTimeType, server_default=db.func.now()),
+            db.Column('DeletedDate', dateTimeType),
             extend_existing=True,
         )
 
@@ -64,21 +92,67 @@ class DashboardClients:
             'DashboardClientsPasswordResetLinks', self.metadata,
             db.Column('ResetToken', db.String(255), nullable=False, primary_key=True),
             db.Column('ClientID', db.String(255), nullable=False),
-            db.Column('CreatedDate',
-                      (db.DATETIME if 'sqlite:///' in ConnectionString("wgdashboard") else db.TIMESTAMP),
-                      server_default=db.func.now()),
-            db.Column('ExpiryDate',
-                      (db.DATETIME if 'sqlite:///' in ConnectionString("wgdashboard") else db.TIMESTAMP)),
+            db.Column('CreatedDate', dateTimeType, server_default=db.func.now()),
+            db.Column('ExpiryDate', dateTimeType),
             extend_existing=True
         )
 
         self.metadata.create_all(self.engine)
+        self.activeEmailIndex.create(self.engine, checkfirst=True)
         self.Clients = {}
         self.ClientsRaw = []
         self.__getClients()
-        self.DashboardClientsTOTP = DashboardClientsTOTP()
+        self.DashboardClientsTOTP = DashboardClientsTOTP(self.engine)
         self.DashboardClientsPeerAssignment = DashboardClientsPeerAssignment(wireguardConfigurations)
         
+    @staticmethod
+    def __getBcryptCost(dashboardConfig) -> int:
+        exist, cost = dashboardConfig.GetConfig("Clients", "bcrypt_cost")
+        if exist and type(cost) is str and cost.isdigit():
+            return min(max(int(cost), 4), 31)
+        return DashboardClients.__calibrateBcryptCost()
+
+    @staticmethod
+    def __calibrateBcryptCost() -> int:
+        """
+        Pick the lowest cost (not below BCRYPT_MIN_COST) that takes at least BCRYPT_TARGET_SECONDS per hash
+        @return: bcrypt cost factor
+        """
+        cost = BCRYPT_MIN_COST
+        while cost < BCRYPT_MAX_COST:
+            start = time.perf_counter()
+            bcrypt.hashpw(b"calibration", bcrypt.gensalt(rounds=cost))
+            if time.perf_counter() - start >= BCRYPT_TARGET_SECONDS:
+                break
+            cost += 1
+        return cost
+
+    @staticmethod
+    def __encodePassword(Password: str) -> bytes:
+        # bcrypt only uses the first 72 bytes, newer releases raise instead of truncating
+        return Password[:BCRYPT_MAX_PASSWORD_BYTES].encode("utf-8")[:BCRYPT_MAX_PASSWORD_BYTES]
+
+    def __hashPassword(self, Password: str, Cost: int = None) -> str:
+        return bcrypt.hashpw(self.__encodePassword(Password),
+                             bcrypt.gensalt(rounds=Cost or self.bcryptCost)).decode("ascii")
+
+    def __createDummyHash(self) -> str:
+        """
+        Hash checked for unknown emails, never cheaper than the hashes of existing clients
+        @return: bcrypt hash of a random password
+        """
+        return self.__hashPassword(secrets.token_urlsafe(16), max(self.bcryptCost, BCRYPT_DEFAULT_COST))
+
+    def __checkPassword(self, Password: str, HashedPassword: str) -> bool:
+        return self.bcryptExecutor.submit(
+            bcrypt.checkpw, self.__encodePassword(Password), HashedPassword.encode("ascii")
+        ).result()
+
+    @staticmethod
+    @lru_cache(maxsize=2048)
+    def __getTotp(TotpKey: str) -> pyotp.TOTP:
+        return pyotp.totp.TOTP(TotpKey)
+
     def __getClients(self):
         with self.engine.connect() as conn:
             localClients = db.select(
@@ -99,23 +173,20 @@ class DashboardClients:
             
             union = db.union(localClients, oidcClients).alias("U")
             
-            self.ClientsRaw = conn.execute(
+            self.ClientsRaw = [ClientRow(**r) for r in conn.execute(
                 db.select(
                     union, 
                     self.dashboardClientsInfoTable.c.Name
                 ).outerjoin(self.dashboardClientsInfoTable, 
                             union.c.ClientID == self.dashboardClientsInfoTable.c.ClientID)
-            ).mappings().fetchall()
+            ).mappings().fetchall()]
             
-            groups = set(map(lambda c: c.get('ClientGroup'), self.ClientsRaw))
-            gr = {}
-            for g in groups:
-                gr[(g if g == 'Local' else self.OIDC.GetProviderNameByIssuer(g))] = [
-                    dict(x) for x in list(
-                        filter(lambda c: c.get('ClientGroup') == g, self.ClientsRaw)
-                    )
-                ]
-            self.Clients = gr
+            groups = {}
+            for c in self.ClientsRaw:
+                groups.setdefault(c.ClientGroup, []).append(c.toJson())
+            self.Clients = {
+                (g if g == 'Local' else self.OIDC.GetProviderNameByIssuer(g)): clients for g, clients in groups.items()
+            }
             
     def GetAllClients(self):
         self.__getClients()
@@ -126,8 +197,7 @@ class DashboardClients:
         return self.ClientsRaw
     
     def GetClient(self, ClientID) -> dict[str, str] | None:
-        c = filter(lambda x: x['ClientID'] == ClientID, self.ClientsRaw)
-        client = next((dict(client) for client in c), None)
+        client = next((c.toJson() for c in self.ClientsRaw if c.ClientID == ClientID), None)
         if client is not None:
             client['ClientGroup'] = self.OIDC.GetProviderNameByIssuer(client['ClientGroup'])
         return client
@@ -145,16 +215,23 @@ class DashboardClients:
     def SignIn_ValidatePassword(self, Email, Password) -> bool:
         if not all([Email, Password]):
             return False
-        existingClient = self.SignIn_UserExistence(Email)
-        if existingClient:
-            return bcrypt.checkpw(Password.encode("utf-8"), existingClient.get("Password").encode("utf-8"))            
-        return False
+        return self.__validateClientPassword(self.SignIn_UserExistence(Email), Password)
+
+    def __validateClientPassword(self, existingClient, Password) -> bool:
+        if existingClient is None:
+            # Check against a dummy hash so unknown emails take as long as known ones
+            self.__checkPassword(Password, self.__dummyHash)
+            return False
+        return self.__checkPassword(Password, existingClient.get("Password"))
         
     def SignIn_UserExistence(self, Email):
         with self.engine.connect() as conn:
             existingClient = conn.execute(
                 self.dashboardClientsTable.select().where(
-                    self.dashboardClientsTable.c.Email == Email
+                    db.and_(
+                        self.dashboardClientsTable.c.Email == Email,
+                        self.dashboardClientsTable.c.DeletedDate.is_(None)
+                    )
                 )
             ).mappings().fetchone()
             return existingClient
@@ -226,13 +303,11 @@ class DashboardClients:
         if not all([Email, Password]):
             return False, "Please fill in all fields"
         existingClient = self.SignIn_UserExistence(Email)
-        if existingClient:
-            checkPwd = self.SignIn_ValidatePassword(Email, Password)
-            if checkPwd:
-                session['SignInMethod'] = 'local'
-                session['Email'] = Email
-                session['ClientID'] = existingClient.get("ClientID")
-                return True, self.DashboardClientsTOTP.GenerateToken(existingClient.get("ClientID"))
+        if self.__validateClientPassword(existingClient, Password):
+            session['SignInMethod'] = 'local'
+            session['Email'] = Email
+            session['ClientID'] = existingClient.get("ClientID")
+            return True, self.DashboardClientsTOTP.GenerateToken(existingClient.get("ClientID"))
         return False, "Email or Password is incorrect"
     
     def SignIn_GetTotp(self, Token: str, UserProvidedTotp: str = None) -> tuple[bool, str] or tuple[bool, None, str]:
@@ -242,10 +317,10 @@ class DashboardClients:
             return False, "TOTP Token is invalid"    
         if UserProvidedTotp is None:
             if data.get('TotpKeyVerified') is None:
-                return True, pyotp.totp.TOTP(data.get('TotpKey')).provisioning_uri(name=data.get('Email'),
-                                                                                   issuer_name="WGDashboard Client")
+                return True, self.__getTotp(data.get('TotpKey')).provisioning_uri(name=data.get('Email'),
+                                                                                  issuer_name="WGDashboard Client")
         else:
-            totpMatched = pyotp.totp.TOTP(data.get('TotpKey')).verify(UserProvidedTotp)
+            totpMatched = self.__getTotp(data.get('TotpKey')).verify(UserProvidedTotp)
             if not totpMatched:
                 return False, "TOTP is does not match"
             else:
@@ -280,12 +355,11 @@ class DashboardClients:
             with self.engine.begin() as conn:
                 newClientUUID = str(uuid.uuid4())
                 totpKey = pyotp.random_base32()
-                encodePassword = Password.encode('utf-8')
                 conn.execute(
                     self.dashboardClientsTable.insert().values({
                         "ClientID": newClientUUID,
                         "Email": Email,
-                        "Password": bcrypt.hashpw(encodePassword, bcrypt.gensalt()).decode("utf-8"),
+                        "Password": self.__hashPassword(Password),
                         "TotpKey": totpKey
                     })
                 )
@@ -322,12 +396,13 @@ class DashboardClients:
                     self.dashboardClientsTable.update().values({
                         "TotpKeyVerified": None,
                         "TotpKey": pyotp.random_base32(),
-                        "Password": bcrypt.hashpw(NewPassword.encode('utf-8'), bcrypt.gensalt()).decode("utf-8"),
+                        "Password": self.__hashPassword(NewPassword),
                     }).where(
                         self.dashboardClientsTable.c.ClientID == ClientID
                     )
                 )
                 self.logger.log(Message=f"User {ClientID} reset password and TOTP")
+            DashboardClients.__getTotp.cache_clear()
         except Exception as e:
             self.logger.log(Status="false", Message=f"User {ClientID} reset password failed, reason: {str(e)}")
             return False, "Reset password failed."
@@ -356,7 +431,7 @@ class DashboardClients:
             with self.engine.begin() as conn:
                 conn.execute(
                     self.dashboardClientsTable.update().values({
-                        "Password": bcrypt.hashpw(NewPassword.encode('utf-8'), bcrypt.gensalt()).decode("utf-8"),
+                        "Password": self.__hashPassword(NewPassword),
                     }).where(
                         self.dashboardClientsTable.c.ClientID == ClientID
                     )
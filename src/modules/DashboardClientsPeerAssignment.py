@@ -31,7 +31,9 @@ class Assignment:
 class DashboardClientsPeerAssignment:
     def __init__(self, wireguardConfigurations: dict[str, WireguardConfiguration]):
         self.logger = DashboardLogger()
-        self.engine = db.create_engine(ConnectionString("wgdashboard"))
+        connectionString = ConnectionString("wgdashboard")
+        dateTimeType = db.DATETIME if 'sqlite:///' in connectionString else db.TIMESTAMP
+        self.engine = db.create_engine(connectionString)
         self.metadata = db.MetaData()
         self.wireguardConfigurations = wireguardConfigurations
         self.dashboardClientsPeerAssignmentTable = db.Table(
@@ -40,11 +42,8 @@ class DashboardClientsPeerAssignment:
             db.Column('ClientID', db.String(255), nullable=False, index=True),
             db.Column('ConfigurationName', db.String(255)),
             db.Column('PeerID', db.String(500)),
-            db.Column('AssignedDate',
-                      (db.DATETIME if 'sqlite:///' in ConnectionString("wgdashboard") else db.TIMESTAMP),
-                      server_default=db.func.now()),
-            db.Column('UnassignedDate',
-                      (db.DATETIME if 'sqlite:///' in ConnectionString("wgdashboard") else db.TIMESTAMP)),
+            db.Column('AssignedDate', dateTimeType, server_default=db.func.now()),
+            db.Column('UnassignedDate', dateTimeType),
             extend_existing=True
         )
         self.metadata.create_all(self.engine)
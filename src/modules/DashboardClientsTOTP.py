@@ -7,15 +7,16 @@ from .ConnectionString import ConnectionString
 
 
 class DashboardClientsTOTP:
-    def __init__(self):
-        self.engine = db.create_engine(ConnectionString("wgdashboard"))
+    def __init__(self, engine: db.Engine = None):
+        self.engine = engine if engine is not None else db.create_engine(ConnectionString("wgdashboard"))
+        dateTimeType = db.DATETIME if self.engine.dialect.name == 'sqlite' else db.TIMESTAMP
         self.metadata = db.MetaData()
         self.dashboardClientsTOTPTable = db.Table(
             'DashboardClientsTOTPTokens', self.metadata,
             db.Column("Token", db.String(500), primary_key=True, index=True),
                 db.Column("ClientID", db.String(500), index=True),
                 db.Column(
-                    "ExpireTime", (db.DATETIME if 'sqlite:///' in ConnectionString("wgdashboard") else db.TIMESTAMP)
+                    "ExpireTime", dateTimeType
                 )
         )
         self.metadata.create_all(self.engine)
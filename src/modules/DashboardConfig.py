@@ -83,6 +83,7 @@ class DashboardConfig:
             },
             "Clients": {
                 "enable": "true",
+                "bcrypt_cost": ""
             },
             "WireGuardConfiguration": {
                 "autostart": ""
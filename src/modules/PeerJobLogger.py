@@ -1,6 +1,10 @@
 """
 Peer Job Logger
 """
+import os
+import queue
+import threading
+import time
 import uuid
 import sqlalchemy as db
 from flask import current_app
@@ -8,52 +12,110 @@ from .ConnectionString import ConnectionString
 from .Log import Log
 
 class PeerJobLogger:
+    QueueSize = 10000
+    BatchSize = 500
+    FlushInterval = 0.2
+    QueryChunkSize = 500
+
     def __init__(self, AllPeerJobs, DashboardConfig):
-        self.engine = db.create_engine(ConnectionString("wgdashboard_log"))                
+        self.engine = db.create_engine(ConnectionString("wgdashboard_log"),
+                                       pool_pre_ping=True, pool_size=5, max_overflow=10)
+        if self.engine.dialect.name == 'sqlite':
+            db.event.listen(self.engine, 'connect', self.__setSqlitePragma)
         self.metadata = db.MetaData()
         self.jobLogTable = db.Table('JobLog', self.metadata,
                                     db.Column('LogID', db.String(255), nullable=False, primary_key=True),
                                     db.Column('JobID', db.String(255), nullable=False),
-                                    db.Column('LogDate', (db.DATETIME if DashboardConfig.GetConfig("Database", "type")[1] == 'sqlite' else db.TIMESTAMP), 
+                                    db.Column('LogDate', (db.DATETIME if DashboardConfig.GetConfig("Database", "type")[1] == 'sqlite' else db.TIMESTAMP),
                                               server_default=db.func.now()),
                                     db.Column('Status', db.String(255), nullable=False),
                                     db.Column('Message', db.Text)
                                     )
+        self.jobIDIndex = db.Index('ix_joblog_jobid', self.jobLogTable.c.JobID)
         self.logs: list[Log] = []
         self.metadata.create_all(self.engine)
+        self.jobIDIndex.create(self.engine, checkfirst=True)
         self.AllPeerJobs = AllPeerJobs
+        self.logger = current_app.logger
+        self.__queue: queue.Queue[dict] = queue.Queue(maxsize=PeerJobLogger.QueueSize)
+        # Started on first use: under gunicorn this object is built in the master,
+        # and a thread started there does not survive the fork into the worker
+        self.__writerLock = threading.Lock()
+        self.__writer: threading.Thread | None = None
+        self.__writerPid: int | None = None
+
+    @staticmethod
+    def __setSqlitePragma(dbapiConnection, connectionRecord):
+        cursor = dbapiConnection.cursor()
+        cursor.execute("PRAGMA journal_mode=WAL")
+        cursor.execute("PRAGMA synchronous=NORMAL")
+        cursor.close()
+
+    def __ensureWriter(self):
+        if self.__writerPid == os.getpid() and self.__writer.is_alive():
+            return
+        with self.__writerLock:
+            if self.__writerPid != os.getpid() or not self.__writer.is_alive():
+                if self.__writerPid not in (None, os.getpid()):
+                    # Pooled connections were inherited from the parent process
+                    self.engine.dispose(close=False)
+                self.__writer = threading.Thread(target=self.__flushLoop, daemon=True)
+                self.__writer.start()
+                self.__writerPid = os.getpid()
+
     def log(self, JobID: str, Status: bool = True, Message: str = "") -> bool:
+        self.__ensureWriter()
         try:
-            with self.engine.begin() as conn:
-                conn.execute(
-                    self.jobLogTable.insert().values(
-                        {
-                            "LogID": str(uuid.uuid4()), 
-                            "JobID": JobID, 
-                            "Status": Status, 
-                            "Message": Message
-                        }
-                    )
-                )
-        except Exception as e:
-            current_app.logger.error(f"Peer Job Log Error", e)
+            self.__queue.put_nowait(
+                {
+                    "JobID": JobID,
+                    "Status": Status,
+                    "Message": Message
+                }
+            )
+        except queue.Full:
+            self.logger.error("Peer Job Log Error: queue is full")
             return False
         return True
 
+    def __flushLoop(self):
+        while True:
+            batch = [self.__queue.get()]
+            deadline = time.monotonic() + PeerJobLogger.FlushInterval
+            while len(batch) < PeerJobLogger.BatchSize:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(self.__queue.get(timeout=timeout))
+                except queue.Empty:
+                    break
+            # One urandom read per batch instead of one per uuid4() call
+            randomBytes = os.urandom(16 * len(batch))
+            for i, record in enumerate(batch):
+                record["LogID"] = uuid.UUID(bytes=randomBytes[i * 16:(i + 1) * 16], version=4).hex
+            try:
+                with self.engine.begin() as conn:
+                    conn.execute(self.jobLogTable.insert(), batch)
+            except Exception as e:
+                self.logger.error("Peer Job Log Error: %s", e)
+
     def getLogs(self, configName = None) -> list[Log]:
         logs: list[Log] = []
         try:
             allJobs = self.AllPeerJobs.getAllJobs(configName)
             allJobsID = [x.JobID for x in allJobs]
-            stmt = self.jobLogTable.select().where(self.jobLogTable.columns.JobID.in_(
-                allJobsID
-            ))
+            # Jobs live in another database, so query in chunks to stay under bound parameter limits
             with self.engine.connect() as conn:
-                table = conn.execute(stmt).fetchall()
-                for l in table:
-                    logs.append(
-                        Log(l.LogID, l.JobID, l.LogDate.strftime("%Y-%m-%d %H:%M:%S"), l.Status, l.Message))
+                for i in range(0, len(allJobsID), PeerJobLogger.QueryChunkSize):
+                    stmt = self.jobLogTable.select().where(self.jobLogTable.columns.JobID.in_(
+                        allJobsID[i:i + PeerJobLogger.QueryChunkSize]
+                    ))
+                    table = conn.execute(stmt).fetchall()
+                    for l in table:
+                        logs.append(
+                            Log(l.LogID, l.JobID, l.LogDate.strftime("%Y-%m-%d %H:%M:%S"), l.Status, l.Message))
         except Exception as e:
             current_app.logger.error(f"Getting Peer Job Log Error", e)
             return logs
-        return logs
\ No newline at end of file
+        return logs
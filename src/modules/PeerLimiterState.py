@@ -2,9 +2,26 @@
 from __future__ import annotations
 
 from datetime import datetime, timezone
-from typing import Iterable, List
+from typing import Dict, Iterable, List, Optional
 
 import sqlalchemy as sa
+from sqlalchemy.dialects import mysql, postgresql, sqlite
+
+# Columns kept from the existing row when an endpoint is upserted again
+_UPSERT_PRESERVED = ("Interface", "PeerID", "Endpoint", "FirstSeen")
+
+# Positional layout of the rows accepted by upsert_sessions_bulk
+SESSION_ROW_COLUMNS = (
+    "Interface", "PeerID", "Endpoint", "LastHandshake", "FirstSeen", "LastSeen",
+    "RxBytes", "TxBytes", "RxDelta", "TxDelta", "IsAllowed",
+)
+
+
+def _as_utc(value: Optional[datetime]) -> Optional[datetime]:
+    # SQLite drops the offset of DateTime(timezone=True) values; they are stored as UTC
+    if value is not None and value.tzinfo is None:
+        return value.replace(tzinfo=timezone.utc)
+    return value
 
 
 class PeerLimiterStateRepository:
@@ -31,7 +48,47 @@ class PeerLimiterStateRepository:
             sa.PrimaryKeyConstraint("Interface", "PeerID", "Endpoint"),
             extend_existing=True,
         )
+        self.last_seen_index = sa.Index(
+            "ix_pls_iface_peer_lastseen",
+            self.sessions_table.c.Interface,
+            self.sessions_table.c.PeerID,
+            self.sessions_table.c.LastSeen.desc(),
+        )
         self.metadata.create_all(self.engine)
+        self.last_seen_index.create(self.engine, checkfirst=True)
+        self.upsert_stmt = self._build_upsert()
+
+    def _build_upsert(self):
+        dialect = self.engine.dialect.name
+        update_columns = [c.name for c in self.sessions_table.c if c.name not in _UPSERT_PRESERVED]
+        if dialect in ("sqlite", "postgresql"):
+            insert = sqlite.insert if dialect == "sqlite" else postgresql.insert
+            stmt = insert(self.sessions_table)
+            return stmt.on_conflict_do_update(
+                index_elements=["Interface", "PeerID", "Endpoint"],
+                set_={name: stmt.excluded[name] for name in update_columns},
+            )
+        if dialect in ("mysql", "mariadb"):
+            stmt = mysql.insert(self.sessions_table)
+            return stmt.on_duplicate_key_update({name: stmt.inserted[name] for name in update_columns})
+        return None
+
+    @staticmethod
+    def _to_record(interface: str, peer_id: str, session: dict, now: datetime) -> dict:
+        return {
+            "Interface": interface,
+            "PeerID": peer_id,
+            "Endpoint": session["Endpoint"],
+            "LastHandshake": session.get("LastHandshake"),
+            "FirstSeen": session.get("FirstSeen", now),
+            "LastSeen": session.get("LastSeen", now),
+            "RxBytes": int(session.get("RxBytes", 0)),
+            "TxBytes": int(session.get("TxBytes", 0)),
+            "RxDelta": int(session.get("RxDelta", 0)),
+            "TxDelta": int(session.get("TxDelta", 0)),
+            "IsAllowed": bool(session.get("IsAllowed", True)),
+            "UpdatedAt": now,
+        }
 
     def upsert_sessions(
         self,
@@ -39,35 +96,55 @@ class PeerLimiterStateRepository:
         peer_id: str,
         sessions: Iterable[dict],
     ) -> None:
-        records: List[dict] = []
         now = datetime.now(timezone.utc)
-        for session in sessions:
-            record = {
-                "Interface": interface,
-                "PeerID": peer_id,
-                "Endpoint": session["Endpoint"],
-                "LastHandshake": session.get("LastHandshake"),
-                "FirstSeen": session.get("FirstSeen", now),
-                "LastSeen": session.get("LastSeen", now),
-                "RxBytes": int(session.get("RxBytes", 0)),
-                "TxBytes": int(session.get("TxBytes", 0)),
-                "RxDelta": int(session.get("RxDelta", 0)),
-                "TxDelta": int(session.get("TxDelta", 0)),
-                "IsAllowed": bool(session.get("IsAllowed", True)),
-                "UpdatedAt": now,
-            }
-            records.append(record)
+        records = [self._to_record(interface, peer_id, session, now) for session in sessions]
+        peer_filter = sa.and_(
+            self.sessions_table.c.Interface == interface,
+            self.sessions_table.c.PeerID == peer_id,
+        )
         with self.engine.begin() as conn:
+            if self.upsert_stmt is None:
+                conn.execute(self.sessions_table.delete().where(peer_filter))
+                if records:
+                    conn.execute(self.sessions_table.insert(), records)
+                return
+            current_endpoints = [record["Endpoint"] for record in records]
             conn.execute(
                 self.sessions_table.delete().where(
-                    sa.and_(
-                        self.sessions_table.c.Interface == interface,
-                        self.sessions_table.c.PeerID == peer_id,
-                    )
+                    peer_filter,
+                    self.sessions_table.c.Endpoint.not_in(current_endpoints),
                 )
             )
             if records:
-                conn.execute(self.sessions_table.insert(), records)
+                conn.execute(self.upsert_stmt, records)
+
+    def upsert_sessions_bulk(self, interfaces: Iterable[str], rows: Iterable[tuple]) -> None:
+        """Replace the stored sessions of every listed interface in one transaction.
+
+        ``rows`` are tuples laid out as ``SESSION_ROW_COLUMNS``; rows of the listed
+        interfaces that are not among them are removed.
+        """
+        now = datetime.now(timezone.utc)
+        records = [dict(zip(SESSION_ROW_COLUMNS, row), UpdatedAt=now) for row in rows]
+        table = self.sessions_table
+        with self.engine.begin() as conn:
+            if self.upsert_stmt is None:
+                conn.execute(table.delete().where(table.c.Interface.in_(list(interfaces))))
+                if records:
+                    conn.execute(table.insert(), records)
+                return
+            current: Dict[str, List[tuple]] = {interface: [] for interface in interfaces}
+            for record in records:
+                current.setdefault(record["Interface"], []).append((record["PeerID"], record["Endpoint"]))
+            for interface, keys in current.items():
+                conn.execute(
+                    table.delete().where(
+                        table.c.Interface == interface,
+                        sa.tuple_(table.c.PeerID, table.c.Endpoint).not_in(keys),
+                    )
+                )
+            if records:
+                conn.execute(self.upsert_stmt, records)
 
     def purge_interface(self, interface: str) -> None:
         with self.engine.begin() as conn:
@@ -76,31 +153,38 @@ class PeerLimiterStateRepository:
             )
 
     def get_sessions(self, interface: str, peer_id: str) -> List[dict]:
+        table = self.sessions_table
         with self.engine.connect() as conn:
             rows = conn.execute(
-                sa.select(self.sessions_table)
-                .where(self.sessions_table.c.Interface == interface)
-                .where(self.sessions_table.c.PeerID == peer_id)
-                .order_by(self.sessions_table.c.LastSeen.desc())
-            ).mappings().all()
-        result: List[dict] = []
+                sa.select(
+                    table.c.Endpoint,
+                    table.c.LastHandshake,
+                    table.c.FirstSeen,
+                    table.c.LastSeen,
+                    table.c.RxBytes,
+                    table.c.TxBytes,
+                    table.c.RxDelta,
+                    table.c.TxDelta,
+                    table.c.IsAllowed,
+                )
+                .where(table.c.Interface == interface)
+                .where(table.c.PeerID == peer_id)
+                .order_by(table.c.LastSeen.desc())
+            ).all()
         now = datetime.now(timezone.utc)
-        for row in rows:
-            last_handshake = row["LastHandshake"]
-            handshake_age = None
-            if last_handshake:
-                handshake_age = int((now - last_handshake).total_seconds())
-            result.append({
-                "endpoint": row["Endpoint"],
+        return [
+            {
+                "endpoint": endpoint,
                 "lastHandshake": last_handshake.isoformat() if last_handshake else None,
-                "handshakeAgeSeconds": handshake_age,
-                "firstSeen": row["FirstSeen"].isoformat() if row["FirstSeen"] else None,
-                "lastSeen": row["LastSeen"].isoformat() if row["LastSeen"] else None,
-                "rxBytes": int(row["RxBytes"] or 0),
-                "txBytes": int(row["TxBytes"] or 0),
-                "rxDelta": int(row["RxDelta"] or 0),
-                "txDelta": int(row["TxDelta"] or 0),
-                "allowed": bool(row["IsAllowed"]),
-            })
-        return result
-
+                "handshakeAgeSeconds": int((now - _as_utc(last_handshake)).total_seconds()) if last_handshake else None,
+                "firstSeen": first_seen.isoformat() if first_seen else None,
+                "lastSeen": last_seen.isoformat() if last_seen else None,
+                "rxBytes": rx_bytes or 0,
+                "txBytes": tx_bytes or 0,
+                "rxDelta": rx_delta or 0,
+                "txDelta": tx_delta or 0,
+                "allowed": bool(is_allowed),
+            }
+            for (endpoint, last_handshake, first_seen, last_seen,
+                 rx_bytes, tx_bytes, rx_delta, tx_delta, is_allowed) in rows
+        ]
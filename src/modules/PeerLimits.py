@@ -1,10 +1,11 @@
 """Peer limit settings and session tracking utilities."""
 from __future__ import annotations
 
+import time
 from dataclasses import dataclass
-from datetime import datetime, timedelta, timezone
+from datetime import datetime, timezone
 from enum import Enum
-from typing import Dict, Iterable, List, Optional
+from typing import Dict, List, NamedTuple, Optional, Set, Tuple, Union
 
 DEFAULT_MAX_CONCURRENT: Optional[int] = None
 DEFAULT_POLICY = "new_wins"
@@ -20,12 +21,16 @@ class PeerLimitPolicy(str, Enum):
 
     @classmethod
     def from_string(cls, value: Optional[str]) -> "PeerLimitPolicy":
-        if value is None:
-            return cls.NEW_WINS
-        try:
-            return cls(value)
-        except ValueError as exc:
-            raise ValueError(f"Unsupported peer limit policy: {value}") from exc
+        policy = _POLICY_MAP.get(value)
+        if policy is None:
+            raise ValueError(f"Unsupported peer limit policy: {value}")
+        return policy
+
+
+_POLICY_MAP: Dict[Optional[str], PeerLimitPolicy] = {
+    None: PeerLimitPolicy.NEW_WINS,
+    **{policy.value: policy for policy in PeerLimitPolicy},
+}
 
 
 @dataclass
@@ -68,12 +73,14 @@ class PeerLimitSettings:
         }
 
 
-@dataclass
+@dataclass(slots=True)
 class PeerSession:
+    """Session state; timestamps are seconds since the epoch (UTC)."""
+
     endpoint: str
-    first_seen: datetime
-    last_seen: datetime
-    last_handshake: Optional[datetime]
+    first_seen: float
+    last_seen: float
+    last_handshake: Optional[float]
     rx_bytes: int
     tx_bytes: int
     rx_delta: int
@@ -83,29 +90,68 @@ class PeerSession:
     def handshake_age(self) -> Optional[int]:
         if self.last_handshake is None:
             return None
-        now = datetime.now(timezone.utc)
-        return int((now - self.last_handshake).total_seconds())
+        return int(time.time() - self.last_handshake)
+
+
+def to_datetime(timestamp: Optional[float]) -> Optional[datetime]:
+    """Convert a tracker timestamp to an aware UTC datetime."""
+    if timestamp is None:
+        return None
+    return datetime.fromtimestamp(timestamp, tz=timezone.utc)
+
+
+def _timestamp(now: Union[datetime, float, None]) -> float:
+    if now is None:
+        return time.time()
+    if isinstance(now, datetime):
+        return now.timestamp()
+    return now
+
+
+def _key(interface: str, peer_id: str) -> str:
+    # NUL cannot appear in interface names, so the composite key is unambiguous
+    return interface + "\x00" + peer_id
+
+
+class SessionSnapshot(NamedTuple):
+    """Active sessions of a peer (newest first) and which endpoints the limit admits."""
+
+    active: List[PeerSession]
+    allowed_endpoints: Set[str]
+    over_limit: bool
 
 
 class SessionTracker:
     """Track session endpoints for peers using TTL and grace logic."""
 
     def __init__(self) -> None:
-        self._sessions: Dict[tuple[str, str], Dict[str, PeerSession]] = {}
+        self._sessions: Dict[str, Dict[str, PeerSession]] = {}
+        # Endpoints added/removed per peer since the last drain_changes() call
+        self._changes: Dict[str, Tuple[Set[str], Set[str]]] = {}
 
-    @staticmethod
-    def _utcnow() -> datetime:
-        return datetime.now(timezone.utc)
+    def _record_change(self, key: str, endpoint: str, added: bool) -> None:
+        changes = self._changes.get(key)
+        if changes is None:
+            changes = self._changes[key] = (set(), set())
+        gained, lost = changes if added else changes[::-1]
+        if endpoint in lost:
+            lost.discard(endpoint)
+        else:
+            gained.add(endpoint)
+
+    def drain_changes(self, interface: str, peer_id: str) -> Tuple[Set[str], Set[str]]:
+        """Return and reset the endpoints ``(added, removed)`` for a peer since the last call."""
+        return self._changes.pop(_key(interface, peer_id), (set(), set()))
 
-    def _expire(self, key: tuple[str, str], ttl_seconds: int, now: Optional[datetime] = None) -> None:
+    def _expire(self, key: str, ttl_seconds: int, now: float) -> None:
         sessions = self._sessions.get(key)
         if not sessions:
             return
-        now = now or self._utcnow()
-        expiry = now - timedelta(seconds=max(ttl_seconds, 1))
+        expiry = now - max(ttl_seconds, 1)
         stale = [endpoint for endpoint, session in sessions.items() if session.last_seen < expiry]
         for endpoint in stale:
             del sessions[endpoint]
+            self._record_change(key, endpoint, added=False)
         if not sessions:
             self._sessions.pop(key, None)
 
@@ -118,48 +164,45 @@ class SessionTracker:
         rx_bytes: int,
         tx_bytes: int,
         settings: PeerLimitSettings,
-        now: Optional[datetime] = None,
+        now: Union[datetime, float, None] = None,
     ) -> List[PeerSession]:
-        key = (interface, peer_id)
-        now = now or self._utcnow()
+        key = _key(interface, peer_id)
+        now = _timestamp(now)
         self._expire(key, settings.ttl_seconds, now)
-        endpoint = endpoint or ""
-        endpoint = endpoint.strip()
+        endpoint = (endpoint or "").strip()
+        if not endpoint or endpoint.lower() == "(none)":
+            # Disconnected peer: nothing to record, and no empty entry to prune later
+            return list(self._sessions.get(key, {}).values())
         sessions = self._sessions.setdefault(key, {})
-        if endpoint and endpoint.lower() != "(none)":
-            existing = sessions.get(endpoint)
-            handshake_dt = (
-                datetime.fromtimestamp(latest_handshake, tz=timezone.utc)
-                if latest_handshake
-                else None
+        existing = sessions.get(endpoint)
+        handshake = float(latest_handshake) if latest_handshake else None
+        rx_bytes = int(rx_bytes)
+        tx_bytes = int(tx_bytes)
+        if existing:
+            rx_delta = rx_bytes - existing.rx_bytes
+            tx_delta = tx_bytes - existing.tx_bytes
+            rx_delta = rx_delta if rx_delta > 0 else 0
+            tx_delta = tx_delta if tx_delta > 0 else 0
+            if rx_delta or tx_delta:
+                existing.last_seen = now
+            existing.rx_bytes = rx_bytes
+            existing.tx_bytes = tx_bytes
+            existing.rx_delta = rx_delta
+            existing.tx_delta = tx_delta
+            if handshake and (existing.last_handshake is None or handshake > existing.last_handshake):
+                existing.last_handshake = handshake
+        else:
+            self._record_change(key, endpoint, added=True)
+            sessions[endpoint] = PeerSession(
+                endpoint=endpoint,
+                first_seen=now,
+                last_seen=now,
+                last_handshake=handshake,
+                rx_bytes=rx_bytes,
+                tx_bytes=tx_bytes,
+                rx_delta=0,
+                tx_delta=0,
             )
-            rx_bytes = int(rx_bytes)
-            tx_bytes = int(tx_bytes)
-            if existing:
-                rx_delta = max(0, rx_bytes - existing.rx_bytes)
-                tx_delta = max(0, tx_bytes - existing.tx_bytes)
-                if rx_delta or tx_delta:
-                    last_seen = now
-                else:
-                    last_seen = existing.last_seen
-                existing.rx_bytes = rx_bytes
-                existing.tx_bytes = tx_bytes
-                existing.rx_delta = rx_delta
-                existing.tx_delta = tx_delta
-                existing.last_seen = last_seen
-                if handshake_dt and (existing.last_handshake is None or handshake_dt > existing.last_handshake):
-                    existing.last_handshake = handshake_dt
-            else:
-                sessions[endpoint] = PeerSession(
-                    endpoint=endpoint,
-                    first_seen=now,
-                    last_seen=now,
-                    last_handshake=handshake_dt,
-                    rx_bytes=rx_bytes,
-                    tx_bytes=tx_bytes,
-                    rx_delta=0,
-                    tx_delta=0,
-                )
         return list(sessions.values())
 
     def active_sessions(
@@ -167,11 +210,10 @@ class SessionTracker:
         interface: str,
         peer_id: str,
         settings: PeerLimitSettings,
-        now: Optional[datetime] = None,
+        now: Union[datetime, float, None] = None,
     ) -> List[PeerSession]:
-        now = now or self._utcnow()
-        ttl_window = now - timedelta(seconds=max(settings.ttl_seconds, 1))
-        sessions = self._sessions.get((interface, peer_id), {})
+        ttl_window = _timestamp(now) - max(settings.ttl_seconds, 1)
+        sessions = self._sessions.get(_key(interface, peer_id), {})
         active = [s for s in sessions.values() if s.last_seen >= ttl_window]
         active.sort(key=lambda s: s.last_seen, reverse=True)
         return active
@@ -181,35 +223,59 @@ class SessionTracker:
         interface: str,
         peer_id: str,
         settings: PeerLimitSettings,
-        now: Optional[datetime] = None,
+        now: Union[datetime, float, None] = None,
     ) -> List[PeerSession]:
-        now = now or self._utcnow()
+        now = _timestamp(now)
         active = self.active_sessions(interface, peer_id, settings, now)
         if settings.max_concurrent in (None, 0):
             return active
-        grace_window = now - timedelta(seconds=max(settings.grace_seconds, 0))
+        grace_window = now - max(settings.grace_seconds, 0)
         grace_sessions = [s for s in active if s.first_seen >= grace_window]
-        stable_sessions = [s for s in active if s not in grace_sessions]
-        allowed: List[PeerSession] = []
-        seen: set[str] = set()
-
-        def append_unique(items: Iterable[PeerSession]) -> None:
-            for session in items:
-                if session.endpoint not in seen:
-                    seen.add(session.endpoint)
-                    allowed.append(session)
-
-        append_unique(grace_sessions)
-        stable_allowed = [session for session in allowed if session not in grace_sessions]
-        remaining = max(settings.max_concurrent - len(stable_allowed), 0)
+        grace_endpoints = {s.endpoint for s in grace_sessions}
+        stable_sessions = [s for s in active if s.endpoint not in grace_endpoints]
+        # Sessions inside the grace window never count against the limit
+        allowed: List[PeerSession] = list(grace_sessions)
+        remaining = settings.max_concurrent
         if remaining <= 0:
             return allowed
         if settings.policy is PeerLimitPolicy.NEW_WINS:
             ordered = stable_sessions
         else:
             ordered = sorted(stable_sessions, key=lambda s: s.first_seen)
-        append_unique(ordered[:remaining])
+        allowed.extend(ordered[:remaining])
         return allowed
 
+    def snapshot(
+        self,
+        interface: str,
+        peer_id: str,
+        settings: PeerLimitSettings,
+        now: Union[datetime, float, None] = None,
+    ) -> SessionSnapshot:
+        """Same result as active_sessions + allowed_sessions with a single TTL pass."""
+        now = _timestamp(now)
+        ttl_window = now - max(settings.ttl_seconds, 1)
+        sessions = self._sessions.get(_key(interface, peer_id), {})
+        active = [s for s in sessions.values() if s.last_seen >= ttl_window]
+        active.sort(key=lambda s: s.last_seen, reverse=True)
+        limit = settings.max_concurrent
+        if limit in (None, 0):
+            return SessionSnapshot(active, {s.endpoint for s in active}, False)
+        grace_window = now - max(settings.grace_seconds, 0)
+        allowed: Set[str] = set()
+        stable: List[PeerSession] = []
+        for session in active:
+            if session.first_seen >= grace_window:
+                allowed.add(session.endpoint)
+            else:
+                stable.append(session)
+        if limit > 0:
+            if settings.policy is not PeerLimitPolicy.NEW_WINS:
+                stable.sort(key=lambda s: s.first_seen)
+            allowed.update(s.endpoint for s in stable[:limit])
+        return SessionSnapshot(active, allowed, len(active) > limit)
+
     def prune_peer(self, interface: str, peer_id: str) -> None:
-        self._sessions.pop((interface, peer_id), None)
+        key = _key(interface, peer_id)
+        for endpoint in self._sessions.pop(key, {}):
+            self._record_change(key, endpoint, added=False)
@@ -3,28 +3,33 @@
 from __future__ import annotations
 
 import argparse
+import base64
+import functools
+import json
 import logging
 import os
 import shlex
 import shutil
 import signal
+import socket
 import subprocess
 import sys
+import threading
 import time
-from collections import defaultdict
+from concurrent.futures import Future, ThreadPoolExecutor
 from dataclasses import dataclass
-from datetime import datetime, timezone
 from typing import Dict, Iterable, List, Optional, Tuple
 
 import sqlalchemy
 
 from modules.ConnectionString import ConnectionString
-from modules.PeerLimits import PeerLimitPolicy, PeerLimitSettings, SessionTracker
+from modules.PeerLimits import PeerLimitPolicy, PeerLimitSettings, SessionTracker, to_datetime
 from modules.PeerLimiterState import PeerLimiterStateRepository
 
 logger = logging.getLogger("wg-go-limiter")
 
 
+@functools.lru_cache(maxsize=4096)
 def split_endpoint(endpoint: str) -> Optional[Tuple[str, int]]:
     endpoint = endpoint.strip()
     if not endpoint or endpoint.lower() == "(none)":
@@ -44,70 +49,314 @@ def split_endpoint(endpoint: str) -> Optional[Tuple[str, int]]:
 class WireGuardDumpCollector:
     """Parse `wg show all dump` output."""
 
+    def __init__(self, wg_path: Optional[str] = None) -> None:
+        self.wg_path = wg_path or shutil.which("wg")
+
     def collect(self) -> Dict[str, dict]:
-        cmd = shutil.which("wg")
+        cmd = self.wg_path
         if not cmd:
             raise RuntimeError("wg binary not found")
-        result = subprocess.run([cmd, "show", "all", "dump"], capture_output=True, text=True, check=False)
-        if result.returncode != 0:
-            raise RuntimeError(result.stderr.strip() or "wg show all dump failed")
+        proc = subprocess.Popen([cmd, "show", "all", "dump"], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        stdout, stderr = proc.communicate()
+        if proc.returncode != 0:
+            raise RuntimeError(stderr.decode(errors="replace").strip() or "wg show all dump failed")
+        return self.parse(stdout)
+
+    @staticmethod
+    def parse(output: bytes) -> Dict[str, dict]:
+        """Parse raw dump bytes; only keys and endpoints are decoded."""
         interfaces: Dict[str, dict] = {}
-        current_iface: Optional[str] = None
-        for line in result.stdout.strip().splitlines():
-            if not line:
-                continue
-            parts = line.split("\t")
+        for line in output.splitlines():
+            parts = line.split(b"\t")
             if len(parts) == 5:
-                current_iface = parts[0]
-                interfaces[current_iface] = {
-                    "listen_port": int(parts[3]) if parts[3] else 0,
+                interfaces[parts[0].decode()] = {
+                    "listen_port": int(parts[3] or b"0"),
                     "peers": []
                 }
-            elif len(parts) >= 8 and current_iface:
-                interfaces[current_iface]["peers"].append({
-                    "public_key": parts[0],
-                    "endpoint": parts[2],
-                    "latest_handshake": int(parts[4]) if parts[4] else 0,
-                    "rx_bytes": int(parts[5]) if parts[5] else 0,
-                    "tx_bytes": int(parts[6]) if parts[6] else 0,
+            elif len(parts) >= 9:
+                iface = interfaces.get(parts[0].decode())
+                if iface is None:
+                    continue
+                # with `all`, peer lines are: interface, public key, preshared key, endpoint,
+                # allowed ips, latest handshake, rx, tx, keepalive
+                iface["peers"].append({
+                    "public_key": parts[1].decode(),
+                    "endpoint": parts[3].decode(),
+                    "latest_handshake": int(parts[5] or b"0"),
+                    "rx_bytes": int(parts[6] or b"0"),
+                    "tx_bytes": int(parts[7] or b"0"),
                 })
         return interfaces
 
 
+class WireGuardUAPICollector:
+    """Read peer state from userspace WireGuard UAPI sockets.
+
+    Sockets are kept open between polls. Kernel WireGuard interfaces have no
+    socket; when any exist they are read from `wg show all dump` instead.
+    """
+
+    SOCKET_DIR = "/var/run/wireguard"
+    SYSFS_NET_DIR = "/sys/class/net"
+
+    def __init__(
+        self,
+        socket_dir: str = SOCKET_DIR,
+        fallback: Optional[WireGuardDumpCollector] = None,
+        timeout: float = 1.0,
+        sysfs_net_dir: str = SYSFS_NET_DIR,
+    ) -> None:
+        self.socket_dir = socket_dir
+        self.sysfs_net_dir = sysfs_net_dir
+        self.timeout = timeout
+        self.fallback = fallback or WireGuardDumpCollector()
+        self._socks: Dict[str, Tuple[socket.socket, object]] = {}
+        # interfaces whose last query failed, so repeated failures are not logged as warnings
+        self._failing: set[str] = set()
+        # netdev name -> whether it is a kernel WireGuard interface
+        self._devtypes: Dict[str, bool] = {}
+        self._pool: Optional[ThreadPoolExecutor] = None
+        self._pool_size = 0
+
+    def _interfaces(self) -> List[str]:
+        try:
+            names = os.listdir(self.socket_dir)
+        except OSError:
+            return []
+        return sorted(name[:-len(".sock")] for name in names if name.endswith(".sock"))
+
+    def _kernel_interfaces(self) -> List[str]:
+        try:
+            names = os.listdir(self.sysfs_net_dir)
+        except OSError:
+            return []
+        # A netdev's type never changes, so uevent is only read for names not seen before
+        for gone in self._devtypes.keys() - set(names):
+            del self._devtypes[gone]
+        for name in names:
+            if name not in self._devtypes:
+                try:
+                    with open(os.path.join(self.sysfs_net_dir, name, "uevent"), "rb") as f:
+                        self._devtypes[name] = b"DEVTYPE=wireguard" in f.read().splitlines()
+                except OSError:
+                    continue
+        return [name for name in names if self._devtypes.get(name)]
+
+    def _connect(self, interface: str) -> Tuple[socket.socket, object]:
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.settimeout(self.timeout)
+            sock.connect(os.path.join(self.socket_dir, f"{interface}.sock"))
+        except OSError:
+            sock.close()
+            raise
+        conn = (sock, sock.makefile("rb"))
+        self._socks[interface] = conn
+        return conn
+
+    def _close(self, interface: str) -> None:
+        conn = self._socks.pop(interface, None)
+        if conn:
+            conn[1].close()
+            conn[0].close()
+
+    def _get(self, interface: str) -> List[bytes]:
+        sock, reader = self._socks.get(interface) or self._connect(interface)
+        sock.sendall(b"get=1\n\n")
+        lines = []
+        while True:
+            line = reader.readline()
+            if not line:
+                raise ConnectionResetError(f"UAPI socket for {interface} closed")
+            line = line.rstrip(b"\n")
+            if not line:
+                return lines
+            lines.append(line)
+
+    def _query(self, interface: str) -> dict:
+        try:
+            lines = self._get(interface)
+        except socket.timeout:
+            # A hung daemon will not answer a fresh connection either
+            raise
+        except OSError:
+            # Stale socket (e.g. the interface was restarted); reconnect once
+            self._close(interface)
+            lines = self._get(interface)
+        info: dict = {"listen_port": 0, "peers": []}
+        peer: Optional[dict] = None
+        for line in lines:
+            key, _, value = line.partition(b"=")
+            if key == b"public_key":
+                peer = {
+                    "public_key": base64.b64encode(bytes.fromhex(value.decode())).decode(),
+                    "endpoint": "(none)",
+                    "latest_handshake": 0,
+                    "rx_bytes": 0,
+                    "tx_bytes": 0,
+                }
+                info["peers"].append(peer)
+            elif key == b"listen_port":
+                info["listen_port"] = int(value)
+            elif key == b"errno":
+                if value != b"0":
+                    raise RuntimeError(f"UAPI get failed for {interface}: errno={value.decode()}")
+            elif peer is None:
+                continue
+            elif key == b"endpoint":
+                peer["endpoint"] = value.decode()
+            elif key == b"last_handshake_time_sec":
+                peer["latest_handshake"] = int(value)
+            elif key == b"rx_bytes":
+                peer["rx_bytes"] = int(value)
+            elif key == b"tx_bytes":
+                peer["tx_bytes"] = int(value)
+        return info
+
+    def collect(self) -> Dict[str, dict]:
+        names = self._interfaces()
+        if not names:
+            return self.fallback.collect()
+        for stale in set(self._socks) - set(names):
+            self._close(stale)
+        self._failing.intersection_update(names)
+        if len(names) == 1:
+            results = [self._safe_query(names[0])]
+        else:
+            # Each interface has its own socket, so round-trips can overlap
+            if self._pool_size < len(names):
+                if self._pool:
+                    self._pool.shutdown(wait=False)
+                self._pool = ThreadPoolExecutor(max_workers=len(names), thread_name_prefix="wg-uapi")
+                self._pool_size = len(names)
+            results = list(self._pool.map(self._safe_query, names))
+        interfaces = {name: info for name, info in zip(names, results) if info is not None}
+        kernel = [name for name in self._kernel_interfaces() if name not in names]
+        if kernel:
+            try:
+                dump = self.fallback.collect()
+            except RuntimeError as exc:
+                logger.warning("Skipping kernel WireGuard interfaces %s: %s", ", ".join(sorted(kernel)), exc)
+            else:
+                for name, info in dump.items():
+                    if name not in names:
+                        interfaces[name] = info
+        return interfaces
+
+    def _safe_query(self, interface: str) -> Optional[dict]:
+        # One failing interface must not take down collection for the others
+        try:
+            info = self._query(interface)
+        except (OSError, RuntimeError, ValueError) as exc:
+            # Socket error, errno reply or malformed response; reconnect on the next poll
+            self._close(interface)
+            if interface in self._failing:
+                logger.debug("UAPI query for %s failed: %s", interface, exc)
+            else:
+                self._failing.add(interface)
+                logger.warning("UAPI query for %s failed, skipping it until it recovers: %s", interface, exc)
+            return None
+        if interface in self._failing:
+            self._failing.discard(interface)
+            logger.info("UAPI query for %s recovered", interface)
+        return info
+
+
 class PeerLimitStore:
     """Fetch per-peer limit settings from the database."""
 
-    def __init__(self, engine: sqlalchemy.Engine) -> None:
+    def __init__(self, engine: sqlalchemy.Engine, cache_ttl: float = 30.0) -> None:
         self.engine = engine
         self.metadata = sqlalchemy.MetaData()
         self.tables: Dict[str, sqlalchemy.Table] = {}
-
-    def _get_table(self, interface: str) -> Optional[sqlalchemy.Table]:
+        self.statements: Dict[str, sqlalchemy.Select] = {}
+        self.cache_ttl = cache_ttl
+        self._cache: Dict[Tuple[str, str], Tuple[float, PeerLimitSettings]] = {}
+
+    def invalidate(self, interface: Optional[str] = None, peer_id: Optional[str] = None) -> None:
+        if interface is None:
+            self._cache.clear()
+        elif peer_id is None:
+            for key in [key for key in self._cache if key[0] == interface]:
+                del self._cache[key]
+        else:
+            self._cache.pop((interface, peer_id), None)
+
+    def _build_table(self, interface: str) -> sqlalchemy.Table:
+        # Only the limit columns are declared, so no reflection round-trip is needed
+        return sqlalchemy.Table(
+            interface,
+            self.metadata,
+            sqlalchemy.Column("id", sqlalchemy.String(255), primary_key=True),
+            sqlalchemy.Column("max_concurrent", sqlalchemy.Integer),
+            sqlalchemy.Column("connection_policy", sqlalchemy.String(32)),
+            sqlalchemy.Column("session_ttl", sqlalchemy.Integer),
+            sqlalchemy.Column("grace_seconds", sqlalchemy.Integer),
+            extend_existing=True,
+        )
+
+    def _get_table(self, interface: str) -> sqlalchemy.Table:
         if interface in self.tables:
             return self.tables[interface]
-        try:
-            table = sqlalchemy.Table(interface, self.metadata, autoload_with=self.engine)
-        except Exception:
-            return None
+        table = self._build_table(interface)
         self.tables[interface] = table
+        self.statements[interface] = sqlalchemy.select(
+            table.c.id,
+            table.c.max_concurrent,
+            table.c.connection_policy,
+            table.c.session_ttl,
+            table.c.grace_seconds,
+        ).where(table.c.id.in_(sqlalchemy.bindparam("peer_ids", expanding=True)))
         return table
 
     def get_peer_settings(self, interface: str, peer_id: str) -> PeerLimitSettings:
-        table = self._get_table(interface)
-        if table is None:
-            return PeerLimitSettings()
-        with self.engine.connect() as conn:
-            row = conn.execute(
-                sqlalchemy.select(
-                    table.c.max_concurrent,
-                    table.c.connection_policy,
-                    table.c.session_ttl,
-                    table.c.grace_seconds,
-                ).where(table.c.id == peer_id)
-            ).mappings().first()
-        if not row:
-            return PeerLimitSettings()
-        return PeerLimitSettings.from_row(row)
+        return self.get_peer_settings_bulk(interface, [peer_id])[peer_id]
+
+    def get_peer_settings_bulk(
+        self,
+        interface: str,
+        peer_ids: Iterable[str],
+        conn: Optional[sqlalchemy.Connection] = None,
+    ) -> Dict[str, PeerLimitSettings]:
+        now = time.monotonic()
+        result: Dict[str, PeerLimitSettings] = {}
+        missing: List[str] = []
+        for peer_id in peer_ids:
+            cached = self._cache.get((interface, peer_id))
+            if cached and now - cached[0] < self.cache_ttl:
+                result[peer_id] = cached[1]
+            else:
+                missing.append(peer_id)
+        if missing:
+            loaded = self._load_peer_settings_bulk(interface, missing, conn)
+            for peer_id in missing:
+                settings = loaded.get(peer_id) or PeerLimitSettings()
+                self._cache[(interface, peer_id)] = (now, settings)
+                result[peer_id] = settings
+        return result
+
+    def _load_peer_settings_bulk(
+        self,
+        interface: str,
+        peer_ids: List[str],
+        conn: Optional[sqlalchemy.Connection] = None,
+    ) -> Dict[str, PeerLimitSettings]:
+        self._get_table(interface)
+        stmt = self.statements[interface]
+        try:
+            if conn is None:
+                with self.engine.connect() as own_conn:
+                    rows = own_conn.execute(stmt, {"peer_ids": peer_ids}).mappings().all()
+            else:
+                rows = conn.execute(stmt, {"peer_ids": peer_ids}).mappings().all()
+        except sqlalchemy.exc.DBAPIError as exc:
+            # Interfaces without a dashboard table (or without the limit columns) use defaults
+            logger.debug("Loading peer limits for %s failed: %s", interface, exc)
+            if conn is not None:
+                # Drop the failed transaction so the shared connection stays usable
+                conn.rollback()
+            return {}
+        return {row["id"]: PeerLimitSettings.from_row(row) for row in rows}
 
 
 @dataclass
@@ -115,6 +364,8 @@ class FirewallSyncPlan:
     ipv4: set
     ipv6: set
     port: int
+    # False when no endpoint was admitted or expired since the previous plan
+    changed: bool = True
 
 
 class FirewallBackend:
@@ -131,12 +382,15 @@ class FirewallBackend:
 
     @staticmethod
     def detect(logger: logging.Logger) -> Optional["FirewallBackend"]:
-        if shutil.which("nft"):
-            backend = NftablesBackend(logger)
+        nft_path = shutil.which("nft")
+        if nft_path:
+            backend = NftablesBackend(logger, nft_path)
             backend.ensure_environment()
             return backend
-        if shutil.which("iptables") and shutil.which("ipset"):
-            backend = IptablesBackend(logger)
+        iptables_path = shutil.which("iptables")
+        ipset_path = shutil.which("ipset")
+        if iptables_path and ipset_path:
+            backend = IptablesBackend(logger, iptables_path, ipset_path)
             backend.ensure_environment()
             return backend
         logger.warning("No supported firewall backend found. Running in fail-open mode.")
@@ -144,75 +398,144 @@ class FirewallBackend:
 
 
 class NftablesBackend(FirewallBackend):
+    """Single-chain nftables backend.
+
+    All interfaces share one input chain; allowed endpoints live in two sets keyed by
+    ``listen port . source address . source port``, so each packet costs one lookup
+    however many interfaces are limited.
+    """
+
     TABLE_NAME = "wggo_limiter"
+    FAMILY = "inet"
+    CHAIN_NAME = "wggo_input"
+    PORTS_SET = "wggo_ports"
+    SET_V4 = "wggo_allowed_v4"
+    SET_V6 = "wggo_allowed_v6"
 
-    def __init__(self, logger: logging.Logger) -> None:
+    def __init__(self, logger: logging.Logger, nft_path: str = "nft") -> None:
         self.logger = logger
-        self.initialized: set[str] = set()
-        self.current_v4: Dict[str, set] = defaultdict(set)
-        self.current_v6: Dict[str, set] = defaultdict(set)
-
-    def _run(self, command: Iterable[str]) -> subprocess.CompletedProcess:
-        cmd = ["nft", *command]
-        result = subprocess.run(cmd, capture_output=True, text=True, check=False)
+        self.nft_path = nft_path
+        # interface -> listen port currently present in the ports set
+        self.ports: Dict[str, int] = {}
+        self.current_v4: Dict[str, frozenset] = {}
+        self.current_v6: Dict[str, frozenset] = {}
+        self._pending: List[dict] = []
+        # sets may hold elements from a previous run, so the first sync rebuilds them all
+        self._dirty = True
+        # set after a failed transaction: the table itself may be gone (e.g. `nft flush ruleset`)
+        self._recreate = False
+
+    def _run(self, command: Iterable[str], input: Optional[str] = None) -> subprocess.CompletedProcess:
+        cmd = [self.nft_path, *command]
+        result = subprocess.run(cmd, input=input, capture_output=True, text=True, check=False)
         if result.returncode != 0:
             self.logger.debug("nft command failed: %s", result.stderr.strip())
         return result
 
+    def _apply(self, commands: List[dict]) -> bool:
+        """Apply JSON ruleset commands as a single atomic `nft -j -f -` transaction."""
+        # Compact separators and no cycle check keep serialization cheap for large element lists
+        payload = json.dumps({"nftables": commands}, separators=(",", ":"), check_circular=False)
+        return self._run(["-j", "-f", "-"], input=payload).returncode == 0
+
+    def _ref(self, **fields: object) -> dict:
+        return {"family": self.FAMILY, "table": self.TABLE_NAME, **fields}
+
+    @staticmethod
+    def _allow_rule(family: str, set_name: str) -> List[dict]:
+        return [
+            {"match": {"op": "==", "left": {"concat": [
+                {"payload": {"protocol": "udp", "field": "dport"}},
+                {"payload": {"protocol": family, "field": "saddr"}},
+                {"payload": {"protocol": "udp", "field": "sport"}},
+            ]}, "right": f"@{set_name}"}},
+            {"return": None},
+        ]
+
+    def _environment_commands(self) -> List[dict]:
+        # Recreating the table also drops the per-interface chains of older versions;
+        # `add` before `delete` keeps the transaction valid on a clean host
+        table = {"family": self.FAMILY, "name": self.TABLE_NAME}
+        return [
+            {"add": {"table": table}},
+            {"delete": {"table": table}},
+            {"add": {"table": table}},
+            {"add": {"set": self._ref(name=self.PORTS_SET, type="inet_service")}},
+            {"add": {"set": self._ref(name=self.SET_V4, type=["inet_service", "ipv4_addr", "inet_service"])}},
+            {"add": {"set": self._ref(name=self.SET_V6, type=["inet_service", "ipv6_addr", "inet_service"])}},
+            {"add": {"chain": self._ref(
+                name=self.CHAIN_NAME, type="filter", hook="input", prio=-150, policy="accept")}},
+            {"add": {"rule": self._ref(chain=self.CHAIN_NAME, expr=self._allow_rule("ip", self.SET_V4))}},
+            {"add": {"rule": self._ref(chain=self.CHAIN_NAME, expr=self._allow_rule("ip6", self.SET_V6))}},
+            {"add": {"rule": self._ref(chain=self.CHAIN_NAME, expr=[
+                {"match": {"op": "==", "left": {"payload": {"protocol": "udp", "field": "dport"}},
+                           "right": f"@{self.PORTS_SET}"}},
+                {"drop": None},
+            ])}},
+        ]
+
     def ensure_environment(self) -> None:
-        if self._run(["list", "table", "inet", self.TABLE_NAME]).returncode != 0:
-            self._run(["add", "table", "inet", self.TABLE_NAME])
+        # Retried from sync() if the table cannot be created now
+        self._recreate = not self._apply(self._environment_commands())
 
     def ensure_interface(self, interface: str, port: int) -> None:
-        if interface in self.initialized:
+        if interface in self.ports:
             return
-        chain = f"wggo_{interface}"
-        set_v4 = f"wggo_{interface}_allowed_v4"
-        set_v6 = f"wggo_{interface}_allowed_v6"
-        if self._run(["list", "set", "inet", self.TABLE_NAME, set_v4]).returncode != 0:
-            self._run(["add", "set", "inet", self.TABLE_NAME, set_v4, "{", "type", "ipv4_addr", ".", "inet_service;", "}" ])
-        if self._run(["list", "set", "inet", self.TABLE_NAME, set_v6]).returncode != 0:
-            self._run(["add", "set", "inet", self.TABLE_NAME, set_v6, "{", "type", "ipv6_addr", ".", "inet_service;", "}" ])
-        if self._run(["list", "chain", "inet", self.TABLE_NAME, chain]).returncode != 0:
-            self._run([
-                "add", "chain", "inet", self.TABLE_NAME, chain,
-                "{", "type", "filter", "hook", "input", "priority", "-150;", "policy", "accept;", "}",
-            ])
-            # insert rules
-            self._run(["add", "rule", "inet", self.TABLE_NAME, chain,
-                       "udp", "dport", str(port), "ip", "saddr", ".", "udp", "sport", "@" + set_v4, "return"])
-            self._run(["add", "rule", "inet", self.TABLE_NAME, chain,
-                       "udp", "dport", str(port), "ip6", "saddr", ".", "udp", "sport", "@" + set_v6, "return"])
-            self._run(["add", "rule", "inet", self.TABLE_NAME, chain,
-                       "udp", "dport", str(port), "drop"])
-        self.initialized.add(interface)
+        self._pending.append({"add": {"element": self._ref(name=self.PORTS_SET, elem=[port])}})
+        self.ports[interface] = port
 
-    def _format_elements(self, elements: Iterable[Tuple[str, int]]) -> str:
-        parts = []
-        for ip, port in elements:
-            if ":" in ip and not ip.startswith("["):
-                ip_repr = f"[{ip}]"
-            else:
-                ip_repr = ip
-            parts.append(f"{ip_repr} . {port}")
-        return "{ " + ", ".join(parts) + " }"
+    @staticmethod
+    def _format_elements(port: int, elements: Iterable[Tuple[str, int]]) -> List[dict]:
+        return [{"concat": [port, ip, sport]} for ip, sport in elements]
 
-    def _sync_set(self, set_name: str, desired: set, current: set) -> set:
-        to_add = desired - current
-        to_remove = current - desired
+    def _sync_set(self, set_name: str, port: int, desired: set, current: frozenset) -> frozenset:
+        changed = desired ^ current
+        to_add = changed & desired
+        to_remove = changed - to_add
         if to_add:
-            self._run(["add", "element", "inet", self.TABLE_NAME, set_name, self._format_elements(to_add)])
+            self._pending.append(
+                {"add": {"element": self._ref(name=set_name, elem=self._format_elements(port, to_add))}})
         if to_remove:
-            self._run(["delete", "element", "inet", self.TABLE_NAME, set_name, self._format_elements(to_remove)])
-        return desired
+            self._pending.append(
+                {"delete": {"element": self._ref(name=set_name, elem=self._format_elements(port, to_remove))}})
+        return frozenset(desired)
 
     def sync(self, plans: Dict[str, FirewallSyncPlan]) -> None:
+        # A moved listen port invalidates every element keyed on it; rebuild rather than patch
+        rebuild = self._dirty or any(
+            self.ports.get(interface, plan.port) != plan.port for interface, plan in plans.items()
+        )
+        if self._recreate:
+            self._pending.extend(self._environment_commands())
+            rebuild = True
+        if rebuild:
+            for set_name in (self.PORTS_SET, self.SET_V4, self.SET_V6):
+                self._pending.append({"flush": {"set": self._ref(name=set_name)}})
+            self.ports.clear()
+            self.current_v4.clear()
+            self.current_v6.clear()
         for interface, plan in plans.items():
+            if not rebuild and (not plan.changed or (plan.ipv4 == self.current_v4.get(interface)
+                                                     and plan.ipv6 == self.current_v6.get(interface))):
+                continue
+            if not plan.port:
+                continue
             self.ensure_interface(interface, plan.port)
-            set_v4 = f"wggo_{interface}_allowed_v4"
-            set_v6 = f"wggo_{interface}_allowed_v6"
-            self.current_v4[interface] = self._sync_set(set_v4, plan.ipv4, self.current_v4.get(interface, set()))
-            self.current_v6[interface] = self._sync_set(set_v6, plan.ipv6, self.current_v6.get(interface, set()))
+            self.current_v4[interface] = self._sync_set(
+                self.SET_V4, plan.port, plan.ipv4, self.current_v4.get(interface, frozenset()))
+            self.current_v6[interface] = self._sync_set(
+                self.SET_V6, plan.port, plan.ipv6, self.current_v6.get(interface, frozenset()))
+        commands, self._pending = self._pending, []
+        if not commands:
+            return
+        if self._apply(commands):
+            self._dirty = False
+            self._recreate = False
+        else:
+            # Tracked state is unreliable after a failed transaction; recreate the table and sets
+            self.logger.warning("nft transaction failed; recreating the limiter table on the next sync")
+            self._dirty = True
+            self._recreate = True
 
     def teardown_peer(self, interface: str) -> None:
         self.current_v4.pop(interface, None)
@@ -222,17 +545,20 @@ class NftablesBackend(FirewallBackend):
 class IptablesBackend(FirewallBackend):
     """iptables/ipset fallback backend (IPv4 only)."""
 
-    def __init__(self, logger: logging.Logger) -> None:
+    def __init__(self, logger: logging.Logger, iptables_path: str = "iptables", ipset_path: str = "ipset") -> None:
         self.logger = logger
-        self.current: Dict[str, set] = defaultdict(set)
+        self.binaries = {"iptables": iptables_path, "ipset": ipset_path}
+        self.current: Dict[str, frozenset] = {}
         self.initialized: set[str] = set()
 
     def ensure_environment(self) -> None:
         # nothing to do globally
         return
 
-    def _run(self, command: Iterable[str]) -> subprocess.CompletedProcess:
-        result = subprocess.run(list(command), capture_output=True, text=True, check=False)
+    def _run(self, command: Iterable[str], input: Optional[str] = None) -> subprocess.CompletedProcess:
+        binary, *args = command
+        result = subprocess.run([self.binaries.get(binary, binary), *args], input=input,
+                                capture_output=True, text=True, check=False)
         if result.returncode != 0:
             self.logger.debug("command failed: %s", result.stderr.strip())
         return result
@@ -252,18 +578,24 @@ class IptablesBackend(FirewallBackend):
 
     def sync(self, plans: Dict[str, FirewallSyncPlan]) -> None:
         for interface, plan in plans.items():
+            fresh = interface not in self.initialized
+            if not fresh and (not plan.changed or plan.ipv4 == self.current.get(interface)):
+                continue
             if plan.ipv6:
                 self.logger.warning("IPv6 endpoints not enforced with iptables backend")
             set_name = f"wggo_{interface}_allowed"
             self.ensure_interface(interface, plan.port)
-            current = self.current.get(interface, set())
-            to_add = plan.ipv4 - current
-            to_remove = current - plan.ipv4
-            for ip, port in to_add:
-                self._run(["ipset", "add", set_name, f"{ip},{port}"])
-            for ip, port in to_remove:
-                self._run(["ipset", "del", set_name, f"{ip},{port}"])
-            self.current[interface] = plan.ipv4
+            # the set may survive a restart, so rebuild it the first time an interface is seen
+            current = frozenset() if fresh else self.current.get(interface, frozenset())
+            changed = plan.ipv4 ^ current
+            to_add = changed & plan.ipv4
+            to_remove = changed - to_add
+            if fresh or to_add or to_remove:
+                lines = [f"flush {set_name}\n"] if fresh else []
+                lines.extend(f"add {set_name} {ip},{port}\n" for ip, port in to_add)
+                lines.extend(f"del {set_name} {ip},{port}\n" for ip, port in to_remove)
+                self._run(["ipset", "restore", "-exist"], input="".join(lines))
+            self.current[interface] = frozenset(plan.ipv4)
 
     def teardown_peer(self, interface: str) -> None:
         self.current.pop(interface, None)
@@ -271,15 +603,21 @@ class IptablesBackend(FirewallBackend):
 
 @dataclass
 class PeerLimiterDaemon:
-    def __init__(self, poll_interval: float = 1.0) -> None:
+    def __init__(self, poll_interval: float = 1.0, settings_ttl: float = 30.0, collector: str = "auto") -> None:
         self.poll_interval = poll_interval
-        self.collector = WireGuardDumpCollector()
+        dump_collector = WireGuardDumpCollector(wg_path=shutil.which("wg"))
+        self.collector = dump_collector if collector == "wg" else WireGuardUAPICollector(
+            fallback=dump_collector, timeout=max(poll_interval, 1.0))
         engine = sqlalchemy.create_engine(ConnectionString("wgdashboard"))
-        self.store = PeerLimitStore(engine)
+        self.engine = engine
+        self.store = PeerLimitStore(engine, cache_ttl=settings_ttl)
         self.tracker = SessionTracker()
         self.state_repo = PeerLimiterStateRepository(engine)
         self.backend = FirewallBackend.detect(logger)
-        self._running = True
+        self._stop_event = threading.Event()
+        self._last_peers: Dict[str, frozenset] = {}
+        self._state_writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="limiter-state")
+        self._pending_write: Optional[Future] = None
         self.metrics = {
             "last_iteration": None,
             "rules_updated": 0,
@@ -287,13 +625,14 @@ class PeerLimiterDaemon:
         }
 
     def stop(self, *_: object) -> None:
-        self._running = False
+        self._stop_event.set()
+        split_endpoint.cache_clear()
 
     def run(self) -> None:
         logger.info("Starting WireGuard limiter daemon")
         signal.signal(signal.SIGTERM, self.stop)
         signal.signal(signal.SIGINT, self.stop)
-        while self._running:
+        while not self._stop_event.is_set():
             start = time.monotonic()
             try:
                 self.iteration()
@@ -302,19 +641,43 @@ class PeerLimiterDaemon:
             elapsed = time.monotonic() - start
             self.metrics["last_iteration"] = elapsed
             sleep_time = max(self.poll_interval - elapsed, 0.1)
-            time.sleep(sleep_time)
+            # Returns as soon as stop() is called instead of finishing the poll interval
+            self._stop_event.wait(sleep_time)
+        self._wait_for_state_write()
+        self._state_writer.shutdown()
         logger.info("Limiter daemon stopped")
 
+    def _wait_for_state_write(self) -> None:
+        future, self._pending_write = self._pending_write, None
+        if future is None:
+            return
+        try:
+            future.result()
+        except Exception as exc:
+            logger.exception("Persisting limiter state failed: %s", exc)
+
     def iteration(self) -> None:
         dump = self.collector.collect()
         plans: Dict[str, FirewallSyncPlan] = {}
         over_limit_count = 0
-        now = datetime.now(timezone.utc)
+        now = time.time()
+        with self.engine.connect() as conn:
+            settings_by_interface = {
+                interface: self.store.get_peer_settings_bulk(
+                    interface, [p["public_key"] for p in info.get("peers", [])], conn
+                )
+                for interface, info in dump.items()
+            }
+        rows: List[tuple] = []
         for interface, info in dump.items():
             plan = FirewallSyncPlan(ipv4=set(), ipv6=set(), port=info.get("listen_port", 0))
+            peer_settings = settings_by_interface[interface]
+            peer_ids = frozenset(peer_settings)
+            changed = self._last_peers.get(interface) != peer_ids
+            self._last_peers[interface] = peer_ids
             for peer_info in info.get("peers", []):
                 peer_id = peer_info["public_key"]
-                settings = self.store.get_peer_settings(interface, peer_id)
+                settings = peer_settings[peer_id]
                 sessions = self.tracker.observe(
                     interface,
                     peer_id,
@@ -325,33 +688,31 @@ class PeerLimiterDaemon:
                     settings,
                     now,
                 )
-                active = self.tracker.active_sessions(interface, peer_id, settings, now)
-                allowed = self.tracker.allowed_sessions(interface, peer_id, settings, now)
-                allowed_endpoints = {s.endpoint for s in allowed}
-                if settings.max_concurrent not in (None, 0) and len(active) > settings.max_concurrent:
+                added, removed = self.tracker.drain_changes(interface, peer_id)
+                if added or removed:
+                    changed = True
+                active, allowed_endpoints, over_limit = self.tracker.snapshot(interface, peer_id, settings, now)
+                if over_limit:
                     over_limit_count += 1
-                records = []
                 for session in active:
                     endpoint_tuple = split_endpoint(session.endpoint)
                     if endpoint_tuple:
-                        ip, port = endpoint_tuple
-                        if ":" in ip:
-                            plan.ipv6.add((ip, port))
+                        if ":" in endpoint_tuple[0]:
+                            plan.ipv6.add(endpoint_tuple)
                         else:
-                            plan.ipv4.add((ip, port))
-                    records.append({
-                        "Endpoint": session.endpoint,
-                        "LastHandshake": session.last_handshake,
-                        "FirstSeen": session.first_seen,
-                        "LastSeen": session.last_seen,
-                        "RxBytes": session.rx_bytes,
-                        "TxBytes": session.tx_bytes,
-                        "RxDelta": session.rx_delta,
-                        "TxDelta": session.tx_delta,
-                        "IsAllowed": session.endpoint in allowed_endpoints,
-                    })
-                self.state_repo.upsert_sessions(interface, peer_id, records)
+                            plan.ipv4.add(endpoint_tuple)
+                rows.extend([
+                    (interface, peer_id, s.endpoint, to_datetime(s.last_handshake), to_datetime(s.first_seen),
+                     to_datetime(s.last_seen), s.rx_bytes, s.tx_bytes, s.rx_delta, s.tx_delta,
+                     s.endpoint in allowed_endpoints)
+                    for s in active
+                ])
+            plan.changed = changed
             plans[interface] = plan
+        # Stored state only feeds the API, so it is written while the firewall syncs;
+        # waiting on the previous write keeps at most one in flight and preserves order
+        self._wait_for_state_write()
+        self._pending_write = self._state_writer.submit(self.state_repo.upsert_sessions_bulk, list(dump), rows)
         self.metrics["peers_over_limit"] = over_limit_count
         if self.backend:
             self.backend.sync(plans)
@@ -365,13 +726,18 @@ def configure_logging(verbose: bool) -> None:
 def main(argv: Optional[List[str]] = None) -> int:
     parser = argparse.ArgumentParser(description="WireGuard peer limiter daemon")
     parser.add_argument("--interval", type=float, default=1.0, help="Polling interval in seconds")
+    parser.add_argument("--settings-ttl", type=float, default=30.0,
+                        help="Seconds to cache per-peer limit settings before re-reading them")
+    parser.add_argument("--collector", choices=("auto", "wg"), default="auto",
+                        help="Peer state source: UAPI sockets when present (auto) or always `wg show all dump`")
     parser.add_argument("--verbose", action="store_true", help="Enable verbose logging")
     args = parser.parse_args(argv)
 
     configure_logging(args.verbose)
 
     try:
-        daemon = PeerLimiterDaemon(poll_interval=args.interval)
+        daemon = PeerLimiterDaemon(poll_interval=args.interval, settings_ttl=args.settings_ttl,
+                                   collector=args.collector)
     except Exception as exc:
         logger.error("Failed to initialize limiter: %s", exc)
         return 1
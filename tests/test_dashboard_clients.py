@@ -0,0 +1,42 @@
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+import sys
+
+import bcrypt
+
+ROOT = Path(__file__).resolve().parents[1]
+SRC = ROOT / "src"
+if str(SRC) not in sys.path:
+    sys.path.insert(0, str(SRC))
+
+from modules.DashboardClients import DashboardClients
+
+
+def _bare_clients(bcryptCost):
+    clients = DashboardClients.__new__(DashboardClients)
+    clients.bcryptCost = bcryptCost
+    clients.bcryptExecutor = ThreadPoolExecutor(max_workers=1)
+    clients._DashboardClients__dummyHash = clients._DashboardClients__createDummyHash()
+    return clients
+
+
+def test_dummy_hash_is_never_cheaper_than_default_cost():
+    clients = _bare_clients(4)
+    assert clients._DashboardClients__dummyHash.startswith("$2b$12$")
+
+
+def test_unknown_and_known_emails_both_check_a_password(monkeypatch):
+    clients = _bare_clients(4)
+    knownHash = bcrypt.hashpw(b"correct horse", bcrypt.gensalt(rounds=4)).decode("ascii")
+    checked = []
+    checkpw = bcrypt.checkpw
+
+    def recording_checkpw(password, hashed):
+        checked.append(hashed)
+        return checkpw(password, hashed)
+
+    monkeypatch.setattr(bcrypt, "checkpw", recording_checkpw)
+    validate = clients._DashboardClients__validateClientPassword
+    assert validate(None, "correct horse") is False
+    assert validate({"Password": knownHash}, "correct horse") is True
+    assert checked == [clients._DashboardClients__dummyHash.encode("ascii"), knownHash.encode("ascii")]
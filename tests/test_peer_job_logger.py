@@ -0,0 +1,41 @@
+from pathlib import Path
+from types import SimpleNamespace
+import sys
+import time
+
+from flask import Flask
+
+ROOT = Path(__file__).resolve().parents[1]
+SRC = ROOT / "src"
+if str(SRC) not in sys.path:
+    sys.path.insert(0, str(SRC))
+
+from modules.PeerJobLogger import PeerJobLogger
+
+
+class DummyDashboardConfig:
+    def GetConfig(self, section, key):
+        return True, "sqlite"
+
+
+class DummyPeerJobs:
+    def getAllJobs(self, configName=None):
+        return [SimpleNamespace(JobID="job-1")]
+
+
+def test_peer_job_logger_writes_logs_read_by_get_logs(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / "wg-dashboard.ini").write_text("[Database]\ntype = sqlite\n")
+    with Flask(__name__).app_context():
+        jobLogger = PeerJobLogger(DummyPeerJobs(), DummyDashboardConfig())
+        assert jobLogger.log("job-1", Message="Peer restricted")
+        assert jobLogger.log("job-2", Status=False, Message="Unrelated job")
+
+        deadline = time.monotonic() + 5
+        logs = jobLogger.getLogs()
+        while not logs and time.monotonic() < deadline:
+            time.sleep(0.05)
+            logs = jobLogger.getLogs()
+
+        assert [(l.JobID, l.Message) for l in logs] == [("job-1", "Peer restricted")]
+        jobLogger.engine.dispose()
@@ -1,10 +1,15 @@
 from datetime import datetime, timedelta, timezone
 from pathlib import Path
+import base64
+import socket
 import sys
+import threading
+import time
 
 import logging
 
 import pytest
+import sqlalchemy
 
 ROOT = Path(__file__).resolve().parents[1]
 SRC = ROOT / "src"
@@ -12,12 +17,14 @@ if str(SRC) not in sys.path:
     sys.path.insert(0, str(SRC))
 
 from modules.PeerLimits import PeerLimitPolicy, PeerLimitSettings, SessionTracker
-from peer_limiter_daemon import NftablesBackend, FirewallSyncPlan
-
-
-class DummyResult:
-    def __init__(self):
-        self.returncode = 0
+from modules.PeerLimiterState import PeerLimiterStateRepository
+from peer_limiter_daemon import (
+    FirewallSyncPlan,
+    NftablesBackend,
+    PeerLimitStore,
+    WireGuardDumpCollector,
+    WireGuardUAPICollector,
+)
 
 
 def test_peer_limit_settings_parsing_defaults():
@@ -94,6 +101,22 @@ def test_session_tracker_grace_period_allows_both():
     assert [session.endpoint for session in allowed_later] == ["10.0.0.2:50001"]
 
 
+def test_session_tracker_snapshot_matches_separate_queries():
+    now = datetime.now(timezone.utc)
+    for policy in (PeerLimitPolicy.NEW_WINS, PeerLimitPolicy.OLD_WINS):
+        tracker = SessionTracker()
+        settings = PeerLimitSettings(max_concurrent=1, policy=policy, ttl_seconds=60, grace_seconds=5)
+        tracker.observe("wg0", "peer", "10.0.0.1:50000", None, 100, 0, settings, now - timedelta(seconds=30))
+        tracker.observe("wg0", "peer", "10.0.0.2:50001", None, 100, 0, settings, now - timedelta(seconds=20))
+        tracker.observe("wg0", "peer", "10.0.0.3:50002", None, 100, 0, settings, now)
+
+        snapshot = tracker.snapshot("wg0", "peer", settings, now)
+        assert snapshot.active == tracker.active_sessions("wg0", "peer", settings, now)
+        allowed = tracker.allowed_sessions("wg0", "peer", settings, now)
+        assert snapshot.allowed_endpoints == {s.endpoint for s in allowed}
+        assert snapshot.over_limit
+
+
 def test_session_tracker_ttl_expires_sessions():
     tracker = SessionTracker()
     settings = PeerLimitSettings(max_concurrent=1, ttl_seconds=5)
@@ -104,28 +127,350 @@ def test_session_tracker_ttl_expires_sessions():
     assert active == []
 
 
+def test_session_tracker_drain_changes_reports_endpoint_churn():
+    tracker = SessionTracker()
+    settings = PeerLimitSettings(max_concurrent=1, ttl_seconds=5)
+    now = datetime.now(timezone.utc)
+    earlier = now - timedelta(seconds=10)
+    tracker.observe("wg0", "peer", "10.0.0.1:50000", None, 100, 0, settings, earlier)
+    assert tracker.drain_changes("wg0", "peer") == ({"10.0.0.1:50000"}, set())
+    tracker.observe("wg0", "peer", "10.0.0.1:50000", None, 100, 0, settings, earlier)
+    assert tracker.drain_changes("wg0", "peer") == (set(), set())
+    tracker.observe("wg0", "peer", "10.0.0.2:50001", None, 100, 0, settings, now)
+    assert tracker.drain_changes("wg0", "peer") == ({"10.0.0.2:50001"}, {"10.0.0.1:50000"})
+
+
+def test_session_tracker_ignores_missing_endpoint():
+    tracker = SessionTracker()
+    settings = PeerLimitSettings(max_concurrent=1)
+    now = datetime.now(timezone.utc)
+    assert tracker.observe("wg0", "peer", "(none)", 0, 0, 0, settings, now) == []
+    assert tracker.observe("wg0", "peer", None, 0, 0, 0, settings, now) == []
+    assert tracker._sessions == {}
+
+
+def test_peer_limit_store_caches_settings():
+    store = PeerLimitStore(sqlalchemy.create_engine("sqlite://"), cache_ttl=60)
+    loads = []
+
+    def fake_load(interface, peer_ids, conn=None):
+        loads.append((interface, list(peer_ids)))
+        return {"peer": PeerLimitSettings(max_concurrent=2)}
+
+    store._load_peer_settings_bulk = fake_load  # type: ignore
+    assert store.get_peer_settings("wg0", "peer").max_concurrent == 2
+    assert store.get_peer_settings("wg0", "peer").max_concurrent == 2
+    assert loads == [("wg0", ["peer"])]
+
+    settings = store.get_peer_settings_bulk("wg0", ["peer", "other"])
+    assert settings["peer"].max_concurrent == 2
+    assert settings["other"].max_concurrent is None
+    assert loads[-1] == ("wg0", ["other"])
+
+    store.invalidate("wg0", "peer")
+    store.get_peer_settings("wg0", "peer")
+    assert len(loads) == 3
+
+
+def _nft_elements(commands, op, set_name="wggo_allowed_v4"):
+    return [
+        tuple(elem["concat"])
+        for command in commands if op in command and command[op].get("element", {}).get("name") == set_name
+        for elem in command[op]["element"]["elem"]
+    ]
+
+
 def test_nftables_backend_diff_operations(monkeypatch):
     backend = NftablesBackend(logging.getLogger("test"))
     backend.current_v4["wg0"] = {("10.0.0.1", 1111)}
     backend.current_v6["wg0"] = set()
-    commands = []
+    batches = []
 
-    def fake_run(args):
-        commands.append(args)
-        result = DummyResult()
-        return result
+    def fake_apply(commands):
+        batches.append(commands)
+        return True
 
-    backend._run = fake_run  # type: ignore
+    backend._apply = fake_apply  # type: ignore
     plan = {"wg0": FirewallSyncPlan(ipv4={("10.0.0.1", 1111), ("10.0.0.2", 2222)}, ipv6=set(), port=51820)}
-    backend.ensure_interface = lambda iface, port: None  # type: ignore
     backend.sync(plan)
 
-    add_commands = [cmd for cmd in commands if "add" in cmd]
-    assert any("10.0.0.2" in " ".join(cmd) for cmd in add_commands)
+    assert len(batches) == 1
+    assert (51820, "10.0.0.2", 2222) in _nft_elements(batches[0], "add")
 
-    commands.clear()
+    batches.clear()
     backend.current_v4["wg0"] = {("10.0.0.1", 1111), ("10.0.0.2", 2222)}
     plan = {"wg0": FirewallSyncPlan(ipv4={("10.0.0.2", 2222)}, ipv6=set(), port=51820)}
     backend.sync(plan)
-    delete_commands = [cmd for cmd in commands if "delete" in cmd]
-    assert any("10.0.0.1" in " ".join(cmd) for cmd in delete_commands)
+    assert _nft_elements(batches[0], "delete") == [(51820, "10.0.0.1", 1111)]
+
+
+def test_nftables_backend_skips_unchanged_plan():
+    backend = NftablesBackend(logging.getLogger("test"))
+    batches = []
+
+    def fake_apply(commands):
+        batches.append(commands)
+        return True
+
+    backend._apply = fake_apply  # type: ignore
+    backend.sync({"wg0": FirewallSyncPlan(ipv4={("10.0.0.1", 1111)}, ipv6=set(), port=51820)})
+    assert {"flush": {"set": {"family": "inet", "table": "wggo_limiter", "name": "wggo_allowed_v4"}}} in batches[0]
+    backend.sync({"wg0": FirewallSyncPlan(ipv4={("10.0.0.1", 1111)}, ipv6=set(), port=51820)})
+    assert len(batches) == 1
+
+
+def test_nftables_backend_rebuilds_sets_after_failed_transaction():
+    backend = NftablesBackend(logging.getLogger("test"))
+    batches = []
+    results = [False, True]
+
+    def fake_apply(commands):
+        batches.append(commands)
+        return results.pop(0)
+
+    backend._apply = fake_apply  # type: ignore
+    plan = {"wg0": FirewallSyncPlan(ipv4={("10.0.0.1", 1111)}, ipv6=set(), port=51820)}
+    backend.sync(plan)
+    backend.sync(plan)
+    assert {"flush": {"set": {"family": "inet", "table": "wggo_limiter", "name": "wggo_allowed_v4"}}} in batches[1]
+    assert _nft_elements(batches[1], "add") == [(51820, "10.0.0.1", 1111)]
+
+
+def test_nftables_backend_recreates_table_after_failed_transaction():
+    backend = NftablesBackend(logging.getLogger("test"))
+    batches = []
+    results = [True, False, True]
+
+    def fake_apply(commands):
+        batches.append(commands)
+        return results.pop(0)
+
+    backend._apply = fake_apply  # type: ignore
+    plan = {"wg0": FirewallSyncPlan(ipv4={("10.0.0.1", 1111)}, ipv6=set(), port=51820)}
+    backend.sync(plan)
+    plan = {"wg0": FirewallSyncPlan(ipv4={("10.0.0.2", 2222)}, ipv6=set(), port=51820)}
+    backend.sync(plan)
+    backend.sync(plan)
+
+    table = {"family": "inet", "name": "wggo_limiter"}
+    assert not any("table" in command.get("add", {}) for command in batches[1])
+    assert batches[2][:3] == [{"add": {"table": table}}, {"delete": {"table": table}}, {"add": {"table": table}}]
+    assert _nft_elements(batches[2], "add") == [(51820, "10.0.0.2", 2222)]
+
+
+def test_state_repository_upsert_preserves_first_seen():
+    repo = PeerLimiterStateRepository(sqlalchemy.create_engine("sqlite://"))
+    now = datetime.now(timezone.utc)
+    first_seen = now - timedelta(hours=1)
+    repo.upsert_sessions("wg0", "peer", [
+        {"Endpoint": "10.0.0.1:50000", "FirstSeen": first_seen, "LastSeen": first_seen},
+        {"Endpoint": "10.0.0.2:50001", "FirstSeen": now, "LastSeen": now},
+    ])
+    repo.upsert_sessions("wg0", "peer", [
+        {"Endpoint": "10.0.0.1:50000", "FirstSeen": now, "LastSeen": now, "RxBytes": 10},
+    ])
+
+    sessions = repo.get_sessions("wg0", "peer")
+    assert [s["endpoint"] for s in sessions] == ["10.0.0.1:50000"]
+    assert sessions[0]["rxBytes"] == 10
+    assert sessions[0]["firstSeen"] == first_seen.replace(tzinfo=None).isoformat()
+
+
+def test_state_repository_reports_handshake_age_on_sqlite(tmp_path):
+    repo = PeerLimiterStateRepository(sqlalchemy.create_engine(f"sqlite:///{tmp_path / 'state.db'}"))
+    now = datetime.now(timezone.utc)
+    repo.upsert_sessions("wg0", "peer", [
+        {"Endpoint": "10.0.0.1:50000", "LastHandshake": now - timedelta(seconds=30), "FirstSeen": now, "LastSeen": now},
+    ])
+
+    sessions = repo.get_sessions("wg0", "peer")
+    assert 29 <= sessions[0]["handshakeAgeSeconds"] <= 60
+
+
+def test_state_repository_bulk_upsert_replaces_interface_sessions():
+    repo = PeerLimiterStateRepository(sqlalchemy.create_engine("sqlite://"))
+    now = datetime.now(timezone.utc)
+    repo.upsert_sessions_bulk(["wg0", "wg1"], [
+        ("wg0", "a", "10.0.0.1:50000", None, now, now, 0, 0, 0, 0, True),
+        ("wg0", "b", "10.0.0.2:50000", None, now, now, 0, 0, 0, 0, True),
+        ("wg1", "a", "10.0.1.1:50000", None, now, now, 0, 0, 0, 0, True),
+    ])
+    repo.upsert_sessions_bulk(["wg0"], [
+        ("wg0", "a", "10.0.0.1:50000", None, now, now, 0, 0, 0, 0, False),
+    ])
+
+    sessions = repo.get_sessions("wg0", "a")
+    assert [s["endpoint"] for s in sessions] == ["10.0.0.1:50000"]
+    assert sessions[0]["allowed"] is False
+    assert repo.get_sessions("wg0", "b") == []
+    assert [s["endpoint"] for s in repo.get_sessions("wg1", "a")] == ["10.0.1.1:50000"]
+
+
+def test_dump_collector_parses_all_dump():
+    output = (
+        b"wg0\tprivkey\tpubkey\t51820\toff\n"
+        b"wg0\tpeerkey=\t(none)\t10.0.0.1:50000\t10.10.0.2/32\t1700000000\t100\t200\toff\n"
+        b"wg0\tidlekey=\t(none)\t(none)\t10.10.0.3/32\t0\t0\t0\toff\n"
+    )
+    assert WireGuardDumpCollector.parse(output) == {"wg0": {"listen_port": 51820, "peers": [
+        {"public_key": "peerkey=", "endpoint": "10.0.0.1:50000", "latest_handshake": 1700000000,
+         "rx_bytes": 100, "tx_bytes": 200},
+        {"public_key": "idlekey=", "endpoint": "(none)", "latest_handshake": 0, "rx_bytes": 0, "tx_bytes": 0},
+    ]}}
+
+
+class EmptyDumpCollector:
+    def collect(self):
+        return {}
+
+
+def _isolated_uapi_collector(tmp_path, **kwargs):
+    # Keep the host's kernel WireGuard interfaces (and the real `wg`) out of the result
+    sysfs = tmp_path / "net"
+    sysfs.mkdir(exist_ok=True)
+    return WireGuardUAPICollector(
+        socket_dir=str(tmp_path), fallback=EmptyDumpCollector(), sysfs_net_dir=str(sysfs), **kwargs
+    )
+
+
+def test_uapi_collector_parses_get_response(tmp_path):
+    public_key = bytes(range(32))
+    response = (
+        "private_key=" + "11" * 32 + "\n"
+        "listen_port=51820\n"
+        "public_key=" + public_key.hex() + "\n"
+        "endpoint=10.0.0.1:50000\n"
+        "last_handshake_time_sec=1700000000\n"
+        "last_handshake_time_nsec=0\n"
+        "rx_bytes=100\n"
+        "tx_bytes=200\n"
+        "allowed_ip=10.10.0.2/32\n"
+        "errno=0\n\n"
+    ).encode()
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(str(tmp_path / "wg0.sock"))
+    server.listen(1)
+
+    def serve():
+        conn, _ = server.accept()
+        with conn:
+            for _ in range(2):
+                request = b""
+                while not request.endswith(b"\n\n"):
+                    request += conn.recv(64)
+                conn.sendall(response)
+
+    thread = threading.Thread(target=serve, daemon=True)
+    thread.start()
+    collector = _isolated_uapi_collector(tmp_path)
+    for _ in range(2):
+        dump = collector.collect()
+        assert dump == {"wg0": {"listen_port": 51820, "peers": [{
+            "public_key": base64.b64encode(public_key).decode(),
+            "endpoint": "10.0.0.1:50000",
+            "latest_handshake": 1700000000,
+            "rx_bytes": 100,
+            "tx_bytes": 200,
+        }]}}
+    thread.join(timeout=1)
+    collector._close("wg0")
+    server.close()
+
+
+def test_uapi_collector_times_out_on_hung_socket(tmp_path):
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(str(tmp_path / "wg0.sock"))
+    server.listen(1)
+    collector = _isolated_uapi_collector(tmp_path, timeout=0.1)
+
+    start = time.monotonic()
+    assert collector.collect() == {}
+    assert time.monotonic() - start < 1
+    server.close()
+
+
+def test_uapi_collector_skips_interface_reporting_errno(tmp_path):
+    replies = {"wg0": b"errno=19\n\n", "wg1": b"listen_port=51821\nerrno=0\n\n"}
+    servers = []
+
+    def serve(server, reply):
+        conn, _ = server.accept()
+        with conn:
+            request = b""
+            while not request.endswith(b"\n\n"):
+                request += conn.recv(64)
+            conn.sendall(reply)
+
+    for name, reply in replies.items():
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        server.bind(str(tmp_path / f"{name}.sock"))
+        server.listen(1)
+        servers.append(server)
+        threading.Thread(target=serve, args=(server, reply), daemon=True).start()
+
+    collector = _isolated_uapi_collector(tmp_path)
+    assert collector.collect() == {"wg1": {"listen_port": 51821, "peers": []}}
+    collector._close("wg1")
+    for server in servers:
+        server.close()
+
+
+def test_uapi_collector_reads_kernel_interfaces_from_dump(tmp_path):
+    socket_dir = tmp_path / "wireguard"
+    socket_dir.mkdir()
+    sysfs = tmp_path / "net"
+    for name, devtype in (("wg0", "wireguard"), ("eth0", None)):
+        (sysfs / name).mkdir(parents=True)
+        (sysfs / name / "uevent").write_text(f"DEVTYPE={devtype}\n" if devtype else "INTERFACE=eth0\n")
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(str(socket_dir / "wg1.sock"))
+    server.listen(1)
+
+    def serve():
+        conn, _ = server.accept()
+        with conn:
+            request = b""
+            while not request.endswith(b"\n\n"):
+                request += conn.recv(64)
+            conn.sendall(b"listen_port=51821\nerrno=0\n\n")
+
+    class FakeDump:
+        def collect(self):
+            return {"wg0": {"listen_port": 51820, "peers": []}, "wg1": {"listen_port": 0, "peers": []}}
+
+    threading.Thread(target=serve, daemon=True).start()
+    collector = WireGuardUAPICollector(socket_dir=str(socket_dir), fallback=FakeDump(), sysfs_net_dir=str(sysfs))
+    assert collector.collect() == {
+        "wg0": {"listen_port": 51820, "peers": []},
+        "wg1": {"listen_port": 51821, "peers": []},
+    }
+    collector._close("wg1")
+    server.close()
+
+
+def test_uapi_collector_warns_once_per_failing_interface(tmp_path, caplog):
+    # A socket file nobody listens on refuses connections
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(str(tmp_path / "wg0.sock"))
+    server.close()
+    collector = _isolated_uapi_collector(tmp_path)
+
+    with caplog.at_level(logging.DEBUG, logger="wg-go-limiter"):
+        assert collector.collect() == {}
+        assert collector.collect() == {}
+    levels = [record.levelno for record in caplog.records if "wg0" in record.getMessage()]
+    assert levels == [logging.WARNING, logging.DEBUG]
+
+
+def test_uapi_collector_caches_netdev_types(tmp_path):
+    sysfs = tmp_path / "net"
+    (sysfs / "wg0").mkdir(parents=True)
+    (sysfs / "wg0" / "uevent").write_text("DEVTYPE=wireguard\nINTERFACE=wg0\n")
+    collector = WireGuardUAPICollector(socket_dir=str(tmp_path), sysfs_net_dir=str(sysfs))
+
+    assert collector._kernel_interfaces() == ["wg0"]
+    (sysfs / "wg0" / "uevent").unlink()
+    assert collector._kernel_interfaces() == ["wg0"]
+    (sysfs / "wg0").rmdir()
+    assert collector._kernel_interfaces() == []
+    assert collector._devtypes == {}